@@ -0,0 +1,324 @@
+"""
+Time a whole archive run against synthetic gazettes in local stores.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/archive.py [--count N] [--workers N]
+        [--db URI] [--save FILE] [--compare FILE] [--tolerance FRACTION]
+
+Generates N (default 500) gazette PDFs with cover pages like GPW's and the
+Western Cape's and a range of page counts, and web_scraped_gazette rows
+for them with matching labels and referrers. Then archive() is run twice
+with file:// stores: once with empty caches and once more after the archive
+is emptied, when the inspection cache is warm. pdftotext needs to be
+installed, as it is for real runs.
+
+The database is a SQLite file unless --db is given, e.g. a local Postgres
+database. It must be a scratch database without any gazettes in it, and
+the gazettes added are deleted afterwards.
+
+Gazettes/sec, peak RSS and the time spent in each stage are reported.
+--save writes them to FILE, and --compare exits with status 1 if
+gazettes/sec is more than --tolerance (default 0.2) below, or peak RSS more
+than --tolerance above, the results saved in FILE.
+"""
+
+from datetime import date, datetime, timedelta
+import getopt
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+GPW = 'http://www.gpwonline.co.za/Gazettes/Pages/'
+WESTERN_CAPE = 'https://www.westerncape.gov.za/general-publication/' \
+               'provincial-gazettes-2016'
+FIRST_DATE = date(2014, 1, 1)
+
+# (referrer, label format, cover page title) of the GPW publications to
+# generate. Labels are formatted with the issue number and date.
+GPW_SOURCES = [
+    (GPW + 'Published-Separate-Gazettes.aspx', '%d %s National Treasury',
+     'Government Gazette'),
+    (GPW + 'Published-National-Government-Gazettes.aspx', '%d NationalGazette',
+     'Government Gazette'),
+    (GPW + 'Published-National-Regulation-Gazettes.aspx', '%d NationalRegulation',
+     'Regulation Gazette'),
+    (GPW + 'Published-Legal-Gazettes.aspx', '%d Legal A',
+     'Government Gazette'),
+    (GPW + 'Published-Liquor-Licenses.aspx', '%d Gauteng Liquor',
+     'Provincial Gazette'),
+    (GPW + 'Provincial-Gazettes-Limpopo.aspx', '%d_%s_LimpSeparate',
+     'Provincial Gazette'),
+]
+# Fraction of GPW gazettes which are indexes
+INDEX_FRACTION = 0.05
+# Text per page, so that files are a realistic size
+PAGE_LINES = 40
+
+
+def main(argv):
+    count = 500
+    workers = 1
+    db_uri = None
+    save_path = None
+    compare_path = None
+    tolerance = 0.2
+    opts, args = getopt.getopt(argv, "n:w:", ["count=", "workers=", "db=",
+                                              "save=", "compare=",
+                                              "tolerance="])
+    for opt, arg in opts:
+        if opt in ('-n', '--count'):
+            count = int(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt == '--db':
+            db_uri = arg
+        elif opt == '--save':
+            save_path = arg
+        elif opt == '--compare':
+            compare_path = arg
+        elif opt == '--tolerance':
+            tolerance = float(arg)
+
+    tmpdir = tempfile.mkdtemp(prefix='gazettes-benchmark')
+    try:
+        results = run(tmpdir, count, workers, db_uri)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for phase in ('cold', 'warm'):
+        report(phase, results[phase])
+    print "peak RSS: %.1fMB (archiver), %.1fMB (largest child)" % (
+        results['peak_rss_kb'] / 1024.0, results['peak_child_rss_kb'] / 1024.0)
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        if not compare(baseline, results, tolerance):
+            sys.exit(1)
+
+
+def run(tmpdir, count, workers, db_uri):
+    scrape_path = os.path.join(tmpdir, 'scrape')
+    cache_path = os.path.join(tmpdir, 'cache')
+    archive_path = os.path.join(tmpdir, 'archive')
+    for path in (scrape_path, cache_path, archive_path):
+        os.mkdir(path)
+    db_uri = db_uri or 'sqlite:///' + os.path.join(tmpdir, 'gazettes.sqlite')
+    metrics_path = os.path.join(tmpdir, 'metrics')
+
+    # The archiver is configured from the environment when it's imported
+    os.environ.update({
+        'WEB_SCRAPE_STORE_URI': 'file://' + scrape_path,
+        'LOCAL_CACHE_STORE_PATH': cache_path,
+        'ARCHIVE_STORE_URI': 'file://' + archive_path,
+        'DB_URI': db_uri,
+        'ARCHIVE_METRICS_PATH': metrics_path,
+        'LOG_LEVEL': 'WARNING',
+    })
+    from gazettes import archive
+    from gazettes.models import Base, WebScrapedGazette, ArchivedGazette, \
+        ArchiveLedger
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    logging.getLogger().setLevel(logging.WARNING)
+
+    engine = create_engine(db_uri)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    if session.query(WebScrapedGazette).count() or \
+       session.query(ArchivedGazette).count() or \
+       session.query(ArchiveLedger).count():
+        raise Exception("%s already has gazettes in it" % db_uri)
+
+    print "Generating %d gazettes" % count
+    start = time.time()
+    rows = list(generate_gazettes(count, scrape_path))
+    session.execute(WebScrapedGazette.__table__.insert(), rows)
+    session.commit()
+    print "Generated in %.1fs" % (time.time() - start)
+
+    results = {'count': count, 'workers': workers}
+    try:
+        for phase in ('cold', 'warm'):
+            start = time.time()
+            archive.archive(False, workers)
+            elapsed = time.time() - start
+            with open(metrics_path + '.json') as f:
+                metrics = json.load(f)
+            results[phase] = {
+                'seconds': elapsed,
+                'gazettes_per_second': count / elapsed,
+                'archived': metrics['counters'].get('archived', 0),
+                'stages': dict((stage, {'count': summary['count'],
+                                        'seconds': summary['seconds'],
+                                        'p95_seconds': summary['p95_seconds']})
+                               for stage, summary
+                               in metrics['stages'].iteritems()),
+            }
+            # Archive everything again from the caches
+            session.query(ArchivedGazette).delete()
+            session.query(ArchiveLedger).delete()
+            session.commit()
+            shutil.rmtree(archive_path)
+            os.mkdir(archive_path)
+    finally:
+        session.query(ArchivedGazette).delete()
+        session.query(ArchiveLedger).delete()
+        session.query(WebScrapedGazette).delete()
+        session.commit()
+        session.close()
+        engine.dispose()
+
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['peak_child_rss_kb'] = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return results
+
+
+def generate_gazettes(count, scrape_path):
+    """
+    Write count synthetic gazette PDFs to scrape_path/full and yield the
+    web_scraped_gazette rows for them. About a quarter are Western Cape
+    gazettes. The rest are from GPW, a few of them indexes.
+    """
+    rng = random.Random(count)
+    os.mkdir(os.path.join(scrape_path, 'full'))
+    now = datetime.now()
+    for i in xrange(count):
+        published_date = FIRST_DATE + timedelta(days=i * 3 // 4)
+        if i % 4 == 3:
+            issue_number = 7000 + i
+            referrer = WESTERN_CAPE
+            label = 'Provincial Gazette %d - %s' % (
+                issue_number, published_date.strftime('%d %B %Y'))
+            cover = ['Province of the Western Cape',
+                     'Provincial Gazette %d' % issue_number,
+                     published_date.strftime('%A, %d %B %Y')]
+        else:
+            issue_number = 37000 + i
+            referrer, label_format, title = GPW_SOURCES[i % len(GPW_SOURCES)]
+            if '%s' in label_format:
+                label = label_format % (issue_number,
+                                        published_date.strftime('%d-%m'))
+            else:
+                label = label_format % issue_number
+            # GPW starts a new volume every six months
+            volume_number = 583 + (published_date.year - 2014) * 2 + \
+                            (published_date.month - 1) // 6
+            cover = [title, 'Staatskoerant',
+                     'REPUBLIC OF SOUTH AFRICA',
+                     'Vol. %d %s No. %d' % (volume_number,
+                                            published_date.strftime('%d %B %Y'),
+                                            issue_number)]
+            if rng.random() < INDEX_FRACTION:
+                cover.insert(0, 'INDEX OF THE %s' % title.upper())
+
+        store_path = 'full/%08d.pdf' % i
+        pagecount = int(rng.lognormvariate(2.5, 0.8)) + 1
+        with open(os.path.join(scrape_path, store_path), 'wb') as f:
+            f.write(make_pdf(cover, pagecount))
+        yield {
+            'original_uri': 'http://example.com/Gazettes/%d.pdf' % i,
+            'store_path': store_path,
+            'label': label,
+            'published_date': published_date,
+            'first_seen': now,
+            'last_seen': now,
+            'referrer': referrer,
+            'manually_ignored': False,
+        }
+
+
+def make_pdf(cover_lines, pagecount):
+    """
+    A PDF with cover_lines on its first page followed by pages of filler
+    text.
+    """
+    # Objects 1-3 are the catalog, page tree and font. Each page is a page
+    # object followed by its content stream.
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join('%d 0 R' % (4 + 2 * page) for page in xrange(pagecount)),
+            pagecount),
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for page in xrange(pagecount):
+        if page == 0:
+            lines = cover_lines
+        else:
+            lines = ['%d. Notice of the filler text on page %d of this gazette'
+                     % (line, page + 1) for line in xrange(PAGE_LINES)]
+        content = 'BT /F1 10 Tf 14 TL 72 760 Td %s ET' % ' '.join(
+            '(%s) Tj T*' % escape_pdf_string(line) for line in lines)
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                       '/Resources << /Font << /F1 3 0 R >> >> '
+                       '/Contents %d 0 R >>' % (5 + 2 * page))
+        objects.append('<< /Length %d >>\nstream\n%s\nendstream'
+                       % (len(content), content))
+
+    pdf = ['%PDF-1.4\n']
+    offsets = []
+    length = len(pdf[0])
+    for number, body in enumerate(objects, 1):
+        offsets.append(length)
+        obj = '%d 0 obj\n%s\nendobj\n' % (number, body)
+        pdf.append(obj)
+        length += len(obj)
+    pdf.append('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    pdf.extend('%010d 00000 n \n' % offset for offset in offsets)
+    pdf.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+               % (len(objects) + 1, length))
+    return ''.join(pdf)
+
+
+def escape_pdf_string(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def report(phase, results):
+    print "%s: %d gazettes archived in %.2fs (%.1f gazettes/s)" % (
+        phase, results['archived'], results['seconds'],
+        results['gazettes_per_second'])
+    print "  %-18s %8s %10s %10s %10s" % ('stage', 'count', 'total s',
+                                          'mean ms', 'p95 ms')
+    for stage, summary in sorted(results['stages'].items(),
+                                 key=lambda item: -item[1]['seconds']):
+        print "  %-18s %8d %10.3f %10.2f %10s" % (
+            stage, summary['count'], summary['seconds'],
+            1000 * summary['seconds'] / summary['count'],
+            '%g' % (1000 * summary['p95_seconds'])
+            if summary['p95_seconds'] is not None else '-')
+
+
+def compare(baseline, results, tolerance):
+    """Print regressions against baseline. Returns whether there were none."""
+    ok = True
+    for phase in ('cold', 'warm'):
+        before = baseline[phase]['gazettes_per_second']
+        after = results[phase]['gazettes_per_second']
+        if after < before * (1 - tolerance):
+            print "REGRESSION: %s run %.1f gazettes/s, was %.1f" % (
+                phase, after, before)
+            ok = False
+    for key in ('peak_rss_kb', 'peak_child_rss_kb'):
+        if results[key] > baseline[key] * (1 + tolerance):
+            print "REGRESSION: %s %d, was %d" % (key, results[key], baseline[key])
+            ok = False
+    if ok:
+        print "No regressions against the baseline"
+    return ok
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+"""
+Time deriving metadata from gazette labels and referrers.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/derive_metadata.py [--count N]
+
+Uses the labels and referrers of web_scraped_gazette in DB_URI if it's set,
+otherwise a small sample of real labels, repeated to make up N gazettes
+(default 100000).
+"""
+
+from itertools import cycle, islice
+import getopt
+import os
+import sys
+import time
+
+from gazettes.metadata import derive_metadata, get_volume_number, rules_cache
+
+GPW = 'http://www.gpwonline.co.za/Gazettes/Pages/'
+WESTERN_CAPE = 'https://www.westerncape.gov.za/general-publication/' \
+               'provincial-gazettes-2016'
+COVER_PAGE_TEXT = 'Government Gazette\nVol. 612 Pretoria, 11 July 2016 No. 40132'
+
+SAMPLE = [
+    (GPW + 'Published-Separate-Gazettes.aspx', '40132 11-07 National Treasury'),
+    (GPW + 'Published-Separate-Gazettes.aspx', '40133 11-07 Icasa'),
+    (GPW + 'Published-National-Regulation-Gazettes.aspx', '39817 NationalRegulation'),
+    (GPW + 'Published-National-Government-Gazettes.aspx', '40101 NationalGazette'),
+    (GPW + 'Published-Legal-Gazettes.aspx', '40126 Legal A'),
+    (GPW + 'Published-Legal-Gazettes.aspx', '40127 LegaB P2'),
+    (GPW + 'Published-Liquor-Licenses.aspx', '40118 NCape Liquor'),
+    (GPW + 'Published-Liquor-Licenses.aspx', '40119 Gauteng Liquor'),
+    (GPW + 'Published-Liquor-Licenses.aspx', '40120 National Liquor'),
+    (GPW + 'Published-Tender-Bulletin.aspx', '2923 1-7 TenderBulletin'),
+    (GPW + 'Road-Access-Permits.aspx', '40098 RoadCarrier'),
+    (GPW + 'Provincial-Gazettes-Limpopo.aspx', '2539_8-9_LimpSeparate'),
+    (GPW + 'Provincial-Gazettes-Gauteng.aspx', '285 Gauteng Extraordinary Part 1'),
+    (WESTERN_CAPE, 'Provincial Gazette 7612 - 15 July 2016'),
+    (WESTERN_CAPE, 'Provincial Gazette Extraordinary 6445a - 18 June 2007'),
+    (WESTERN_CAPE, 'Provincial Gazette Extraordinary 6445e - 18 June 2007'),
+]
+
+
+def main(argv):
+    count = 100000
+    opts, args = getopt.getopt(argv, "n:", ["count="])
+    for opt, arg in opts:
+        if opt in ('-n', '--count'):
+            count = int(arg)
+
+    gazettes = list(islice(cycle(load_gazettes()), count))
+    rules_cache.clear()
+
+    errors = 0
+    start = time.time()
+    for referrer, label in gazettes:
+        try:
+            derive_metadata(referrer, label)
+            get_volume_number(referrer, COVER_PAGE_TEXT)
+        except Exception:
+            errors += 1
+    elapsed = time.time() - start
+
+    print "%d gazettes in %.3fs: %.0f/s, %.2fus/gazette, %d errors" % (
+        len(gazettes), elapsed, len(gazettes) / elapsed,
+        1000000 * elapsed / len(gazettes), errors)
+
+
+def load_gazettes():
+    db_uri = os.environ.get('DB_URI')
+    if not db_uri:
+        return SAMPLE
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from gazettes.models import WebScrapedGazette
+    engine = create_engine(db_uri)
+    session = sessionmaker(bind=engine)()
+    gazettes = session.query(WebScrapedGazette.referrer,
+                             WebScrapedGazette.label).all()
+    session.close()
+    engine.dispose()
+    return gazettes
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+"""
+Compare reading page counts with gazettes.pdf against running pdfinfo.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/pdf_page_count.py [--repeat N] PATH...
+
+Each PATH is a PDF or a directory which is searched for PDFs, e.g. the
+local archive cache. Files the native inspector can't read, or where it
+disagrees with pdfinfo, are listed at the end.
+"""
+
+import getopt
+import os
+import sys
+import time
+
+from gazettes import pdf
+from gazettes.archive import get_pdfinfo_page_count
+
+
+def main(argv):
+    repeat = 3
+    opts, args = getopt.getopt(argv, "r:", ["repeat="])
+    for opt, arg in opts:
+        if opt in ('-r', '--repeat'):
+            repeat = int(arg)
+    if not args:
+        print __doc__
+        sys.exit(2)
+
+    paths = list(find_pdfs(args))
+    native_pages = {}
+    failed = {}
+    pdfinfo_pages = {}
+
+    native_time = best_of(repeat, lambda: read_native(paths, native_pages, failed))
+    pdfinfo_time = best_of(repeat, lambda: read_pdfinfo(paths, pdfinfo_pages))
+
+    mismatched = [path for path in native_pages
+                  if native_pages[path] != pdfinfo_pages[path]]
+
+    print "%d files, %d pages" % (len(paths), sum(pdfinfo_pages.values()))
+    report("pdfinfo", pdfinfo_time, len(paths))
+    report("native", native_time, len(paths))
+    if native_time:
+        print "speedup: %.1fx" % (pdfinfo_time / native_time)
+    print "native couldn't read %d files (pdfinfo fallback):" % len(failed)
+    for path, error in sorted(failed.items()):
+        print "  %s: %s" % (path, error)
+    print "native disagreed with pdfinfo on %d files:" % len(mismatched)
+    for path in sorted(mismatched):
+        print "  %s: %d != %d" % (path, native_pages[path], pdfinfo_pages[path])
+
+
+def find_pdfs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.lower().endswith('.pdf'):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def read_native(paths, pages, failed):
+    for path in paths:
+        try:
+            pages[path] = pdf.get_info(path)['pages']
+        except pdf.PDFError, e:
+            failed[path] = e
+
+
+def read_pdfinfo(paths, pages):
+    for path in paths:
+        pages[path] = get_pdfinfo_page_count(path)
+
+
+def best_of(repeat, fn):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def report(name, seconds, count):
+    print "%-8s %8.3fs  %8.2fms/file" % (name, seconds,
+                                         1000 * seconds / count if count else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
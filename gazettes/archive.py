@@ -5,7 +5,16 @@ structured paths.
 """
 
 from gazettes.models import WebScrapedGazette, ArchivedGazette
-from sqlalchemy import create_engine
+from gazettes.inspection import Inspection, InspectionCache, content_hash
+from gazettes.cache import LocalCache
+from gazettes.claims import Claims
+from gazettes.metrics import Metrics
+from gazettes import pdf
+from gazettes.metadata import derive_metadata, get_volume_number, \
+    has_volume_number, NeedsOCRError, UnknownReferrerError
+from gazettes.ledger import Ledger
+from gazettes.volumes import VolumeIndex
+from sqlalchemy import create_engine, text, bindparam
 from sqlalchemy.orm import sessionmaker
 from urlparse import urlparse
 import os
@@ -17,6 +26,13 @@ import logging
 import pdb
 import sys
 import getopt
+import time
+import json
+from collections import namedtuple, defaultdict, deque
+from itertools import imap
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import threading
 import boto
 from boto.s3.key import Key
 
@@ -29,19 +45,76 @@ ARCHIVE_STORE_URI = os.environ.get('ARCHIVE_STORE_URI')
 GAZETTE_DB_URI = os.environ.get('GAZETTE_DB_URI')
 DB_URI = os.environ.get('DB_URI')
 LOG_LEVEL = os.environ.get('LOG_LEVEL')
+# Defaults to a file in LOCAL_CACHE_STORE_PATH
+INSPECTION_CACHE_PATH = os.environ.get('INSPECTION_CACHE_PATH')
+INSPECTION_CACHE_MAX_ENTRIES = int(os.environ.get('INSPECTION_CACHE_MAX_ENTRIES',
+                                                  100000))
+# Files in LOCAL_CACHE_STORE_PATH are evicted, least recently used first,
+# once they take up more than this. Unbounded if it isn't set.
+LOCAL_CACHE_MAX_BYTES = os.environ.get('LOCAL_CACHE_MAX_BYTES')
+LOCAL_CACHE_MAX_BYTES = int(LOCAL_CACHE_MAX_BYTES) if LOCAL_CACHE_MAX_BYTES else None
+# Defaults to a file in LOCAL_CACHE_STORE_PATH
+ARCHIVE_CHECKPOINT_PATH = os.environ.get('ARCHIVE_CHECKPOINT_PATH')
+# Metrics are written to this path with .json and .prom appended. Defaults
+# to archive-metrics in LOCAL_CACHE_STORE_PATH
+ARCHIVE_METRICS_PATH = os.environ.get('ARCHIVE_METRICS_PATH')
+
+# Number of web_scraped_gazette rows fetched from the database at a time
+STREAM_BATCH_SIZE = 1000
+# Number of gazettes queued for each worker process at a time
+IN_FLIGHT_PER_WORKER = 4
+# Number of new ArchivedGazettes inserted per transaction
+DEFAULT_BATCH_SIZE = 100
+# Seconds to wait for pdftotext to extract a cover page
+PDFTOTEXT_TIMEOUT = 60
+# Cover page text beyond this is discarded
+COVER_PAGE_TEXT_MAX_BYTES = 1024 * 1024
+# Number of gazettes to download ahead of the one being processed
+DEFAULT_PREFETCH = 8
+# Number of threads downloading ahead
+PREFETCH_THREADS = 4
+# Number of threads uploading to the archive store
+UPLOAD_THREADS = 4
+# Gazettes being downloaded ahead or waiting to be processed may not take
+# up more space than this
+PREFETCH_MAX_BYTES = int(os.environ.get('PREFETCH_MAX_BYTES', 512 * 1024 * 1024))
+# Space reserved for a download before any have finished. After that the
+# average size of the finished downloads is reserved.
+PREFETCH_EXPECTED_BYTES = 4 * 1024 * 1024
+# Seconds between checkpoints. A partial batch is flushed to checkpoint if
+# a full one hasn't been flushed for this long.
+CHECKPOINT_INTERVAL = 60
+# Number of consecutive web_scraped_gazette ids claimed at a time when
+# archivers share a run
+CLAIM_BLOCK_SIZE = 500
+# Seconds a claim is held for without being renewed
+CLAIM_LEASE_SECONDS = 600
 
 logger.setLevel(LOG_LEVEL)
 
 
-class NeedsOCRError(Exception):
-    pass
-
-
 def main(argv):
     pdb_on_error = False
+    workers = 1
+    incremental = False
+    batch_size = DEFAULT_BATCH_SIZE
+    prefetch = DEFAULT_PREFETCH
+    resume = False
+    claim_run = None
+    metrics_interval = None
+    retry_all = False
+    rederive_mode = False
 
     try:
-        opts, args = getopt.getopt(argv, "hd", ["help", "pdb"])
+        opts, args = getopt.getopt(argv, "hdw:ib:p:rc:m:aR", ["help", "pdb", "workers=",
+                                                                "incremental",
+                                                                "batch-size=",
+                                                                "prefetch=",
+                                                                "resume",
+                                                                "claim=",
+                                                                "metrics-interval=",
+                                                                "retry-all",
+                                                                "rederive"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -52,361 +125,1457 @@ def main(argv):
             sys.exit()
         elif opt in ('-d', '--pdb'):
             pdb_on_error = True
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-i', '--incremental'):
+            incremental = True
+        elif opt in ('-b', '--batch-size'):
+            batch_size = int(arg)
+        elif opt in ('-p', '--prefetch'):
+            prefetch = int(arg)
+        elif opt in ('-r', '--resume'):
+            resume = True
+        elif opt in ('-c', '--claim'):
+            claim_run = arg
+        elif opt in ('-m', '--metrics-interval'):
+            metrics_interval = int(arg)
+        elif opt in ('-a', '--retry-all'):
+            retry_all = True
+        elif opt in ('-R', '--rederive'):
+            rederive_mode = True
+
+    if pdb_on_error and workers > 1:
+        print "--pdb can only be used with a single worker"
+        sys.exit(2)
+
+    if resume and claim_run:
+        print "--resume can't be used with --claim - claimed runs carry on " \
+            "where they left off anyway"
+        sys.exit(2)
+
+    if rederive_mode and (incremental or resume or claim_run or retry_all):
+        print "--rederive goes through every archived gazette, so it can't be " \
+            "used with --incremental, --resume, --claim or --retry-all"
+        sys.exit(2)
+
+    if rederive_mode:
+        run = lambda: rederive(pdb_on_error, workers, batch_size,
+                               metrics_interval)
+    else:
+        run = lambda: archive(pdb_on_error, workers, incremental, batch_size,
+                              prefetch, resume, claim_run, metrics_interval,
+                              retry_all)
 
     if pdb_on_error:
         try:
-            archive(pdb_on_error)
+            run()
         except Exception, e:
             logger.exception(e)
             ype, value, tb = sys.exc_info()
             pdb.post_mortem(tb)
     else:
-        archive(pdb_on_error)
+        run()
+
+
+def usage():
+    print "Usage: python gazettes/archive.py [options]"
+    print ""
+    print "  -h, --help         Show this help"
+    print "  -d, --pdb          Drop into pdb post-mortem on errors"
+    print "  -w, --workers N    Process gazettes in a pool of N processes"
+    print "  -i, --incremental  Only process gazettes whose original_uri is not"
+    print "                     in the archive yet"
+    print "  -b, --batch-size N Upload and insert new gazettes N at a time"
+    print "                     (default %d)" % DEFAULT_BATCH_SIZE
+    print "  -p, --prefetch N   Download up to N gazettes ahead in the background"
+    print "                     (default %d, 0 to disable)" % DEFAULT_PREFETCH
+    print "  -r, --resume       Continue from where an interrupted run got to"
+    print "  -c, --claim RUN    Share the run named RUN with other archivers using"
+    print "                     the same database by claiming blocks of gazettes"
+    print "  -m, --metrics-interval N"
+    print "                     Write metrics every N seconds as well as at the end"
+    print "  -a, --retry-all    Also process gazettes which the ledger says failed"
+    print "                     or aren't due to be retried yet"
+    print "  -R, --rederive     Work out the metadata of every archived gazette"
+    print "                     again and update the columns which changed"
+
+
+# The columns of WebScrapedGazette the archiver needs. Only these are
+# selected, and workers get them rather than ORM instances so that they can
+# be pickled cheaply.
+ScrapedGazette = namedtuple('ScrapedGazette', [
+    'id',
+    'store_path',
+    'original_uri',
+    'referrer',
+    'label',
+    'published_date',
+])
+
+# What a worker found out about a ScrapedGazette. archived_gazette is the
+# dict for ArchivedGazette.fromDict, or None if the gazette should not be
+# archived (an index, or an error which the worker has already logged).
+# fetched is whether the PDF had to be downloaded into the local cache, or
+# None if the PDF wasn't needed. metrics is a Metrics snapshot of the work
+# done on the gazette. outcome says why a gazette can't be archived (see
+# gazettes.ledger) and reason is the error, if there was one.
+# inspections_used is the content hashes of the inspection cache entries
+# that were hit, so that the main process can mark them as used.
+ProcessedGazette = namedtuple('ProcessedGazette', [
+    'webgazette',
+    'archived_gazette',
+    'outcome',
+    'reason',
+    'inspection_cached',
+    'inspections_used',
+    'fetched',
+    'worker',
+    'elapsed',
+    'metrics',
+])
+
+# The columns of ArchivedGazette which are worked out from a scraped
+# gazette and its inspection, and so can change when the rules change.
+DERIVED_COLUMNS = (
+    'archive_path',
+    'publication_title',
+    'publication_subtitle',
+    'special_issue',
+    'language_edition',
+    'issue_number',
+    'volume_number',
+    'jurisdiction_code',
+    'publication_date',
+    'unique_id',
+    'pagecount',
+    'part',
+)
+
+# What a worker re-derived for an archived gazette. archived is a dict of
+# the row's id and DERIVED_COLUMNS as they are in the database, and changes
+# is a dict of the columns whose values changed, or None if there was an
+# error.
+RederivedGazette = namedtuple('RederivedGazette', [
+    'archived',
+    'webgazette',
+    'changes',
+    'fetched',
+    'inspections_used',
+    'worker',
+    'elapsed',
+    'metrics',
+])
+
+# Per-process state for process_gazette, set up by init_worker.
+worker_state = {}
+
+
+def archive(pdb_on_error, workers=1, incremental=False,
+            batch_size=DEFAULT_BATCH_SIZE, prefetch=DEFAULT_PREFETCH,
+            resume=False, claim_run=None, metrics_interval=None,
+            retry_all=False):
+    tmpdir = mkdtemp(prefix='gazettes-archive')
+    engine = create_engine(DB_URI)
+    Session = sessionmaker(bind=engine)
+    webscraped_sesh = Session()
+    metrics = Metrics()
+    metrics_path = ARCHIVE_METRICS_PATH or \
+                   os.path.join(LOCAL_CACHE_STORE_PATH, 'archive-metrics')
+    uploader = Uploader(WEB_SCRAPE_STORE_URI, ARCHIVE_STORE_URI, UPLOAD_THREADS,
+                        metrics)
+    inspection_cache_path = INSPECTION_CACHE_PATH or \
+                            os.path.join(LOCAL_CACHE_STORE_PATH,
+                                         'inspection-cache.sqlite')
+    # When both stores are in S3, the archive copy is made within S3 and
+    # the local copy is only needed if the PDF hasn't been inspected yet.
+    server_side_copy = supports_server_side_copy(WEB_SCRAPE_STORE_URI,
+                                                 ARCHIVE_STORE_URI)
+
+    query = webscraped_sesh.query(*[getattr(WebScrapedGazette, field)
+                                    for field in ScrapedGazette._fields])\
+                           .filter(WebScrapedGazette.manually_ignored == False)
+    if incremental:
+        # Anti-join: only gazettes that haven't been archived under their
+        # original_uri. Indexes and gazettes that failed are still retried.
+        query = query.outerjoin(ArchivedGazette,
+                                ArchivedGazette.original_uri
+                                == WebScrapedGazette.original_uri)\
+                     .filter(ArchivedGazette.id == None)
+
+    checkpoint = Checkpoint(ARCHIVE_CHECKPOINT_PATH or
+                            os.path.join(LOCAL_CACHE_STORE_PATH,
+                                         'archive-checkpoint.json'))
+    if resume:
+        resume_after = checkpoint.load()
+        if resume_after is None:
+            logger.info("No checkpoint in %s. Starting from the beginning.",
+                        checkpoint.path)
+        else:
+            logger.info("Resuming after web_scraped_gazette %d", resume_after)
+            query = query.filter(WebScrapedGazette.id > resume_after)
+
+    with metrics.timer('db_lookup'):
+        archive_index = ArchiveIndex.load(webscraped_sesh)
+    logger.info("%d gazettes in the archive", len(archive_index))
+    with metrics.timer('db_lookup'):
+        ledger = Ledger.load(webscraped_sesh)
+    logger.info("%d gazettes in the ledger", len(ledger))
+    with metrics.timer('db_lookup'):
+        volume_index = VolumeIndex.load(webscraped_sesh)
+    logger.info("%d date ranges with known volume numbers", len(volume_index))
+
+    if claim_run:
+        claims = Claims(engine, claim_run, CLAIM_BLOCK_SIZE, CLAIM_LEASE_SECONDS)
+        claims.seed()
+        webgazettes = (webgazette
+                       for first_id, end_id in claims
+                       for webgazette in stream_gazettes(
+                           query.filter(WebScrapedGazette.id >= first_id,
+                                        WebScrapedGazette.id < end_id)))
+    else:
+        claims = None
+        webgazettes = stream_gazettes(query)
+    webgazettes = (webgazette for webgazette in webgazettes
+                   if not archive_index.is_archived(webgazette)
+                   and (retry_all or not ledger.should_skip(webgazette))
+                   and not is_known_duplicate(webgazette, archive_index,
+                                              volume_index, metrics))
+    # Files are pinned before they're prefetched so that they aren't
+    # evicted before they're processed and uploaded.
+    local_cache = LocalCache(LOCAL_CACHE_STORE_PATH, LOCAL_CACHE_MAX_BYTES)
+    webgazettes = local_cache.pin_all(webgazettes)
+    # Only used to decide what to prefetch
+    prefetch_inspection_cache = None
+    if prefetch:
+        if server_side_copy:
+            prefetch_inspection_cache = InspectionCache(
+                inspection_cache_path, INSPECTION_CACHE_MAX_ENTRIES)
+            needs_download = lambda webgazette: \
+                not prefetch_inspection_cache.has_store_path(webgazette.store_path)
+        else:
+            needs_download = None
+        webgazettes = Prefetcher(WEB_SCRAPE_STORE_URI,
+                                 LOCAL_CACHE_STORE_PATH,
+                                 prefetch,
+                                 PREFETCH_MAX_BYTES,
+                                 metrics,
+                                 needs_download)(webgazettes)
+
+    worker_args = (WEB_SCRAPE_STORE_URI,
+                   LOCAL_CACHE_STORE_PATH,
+                   inspection_cache_path,
+                   server_side_copy,
+                   volume_index,
+                   pdb_on_error)
+    if workers > 1:
+        pool = Pool(workers, init_worker, worker_args)
+        results = imap_bounded(pool, process_gazette, webgazettes,
+                               workers * IN_FLIGHT_PER_WORKER)
+    else:
+        pool = None
+        init_worker(*worker_args)
+        results = imap(process_gazette, webgazettes)
+
+    throughput = defaultdict(lambda: [0, 0.0])
+    inspection_stats = defaultdict(int)
+    inspections_used = set()
+    start = time.time()
+    batch = []
+    # Results come back in id order, so once a result's batch has been
+    # flushed every row up to its id has been dealt with.
+    last_id = None
+    last_checkpoint = time.time()
+    last_metrics = time.time()
+
+    def flush():
+        if claims:
+            flush_locked_batch(Session, archive_index, uploader, batch,
+                               metrics, pdb_on_error)
+        else:
+            flush_batch(Session, archive_index, batch, metrics, pdb_on_error)
+        for webgazette, archived_gazette, upload in batch:
+            local_cache.unpin(webgazette.store_path)
+            existing_original_uri = archive_index.get(archived_gazette['unique_id'])
+            if existing_original_uri == webgazette.original_uri:
+                ledger.resolve(webgazette)
+            elif existing_original_uri is None:
+                ledger.record(webgazette, 'error', "Upload or insert failed")
+            # Otherwise another archiver archived a different gazette with
+            # the same unique_id first. That's a collision, which has been
+            # logged and isn't kept in the ledger, like the collisions found
+            # before a gazette is batched.
+        del batch[:]
+        ledger.flush(Session)
+        if last_id is not None:
+            if claims:
+                claims.archived_through(last_id)
+            else:
+                checkpoint.save(last_id)
+        local_cache.evict()
+
+    for result in results:
+        throughput[result.worker][0] += 1
+        throughput[result.worker][1] += result.elapsed
+        metrics.merge(result.metrics)
+        if result.inspection_cached is not None:
+            inspection_stats[result.inspection_cached] += 1
+        inspections_used.update(result.inspections_used)
+        webgazette = result.webgazette
+        last_id = webgazette.id
+        if result.fetched is not None:
+            local_cache.used(webgazette.store_path, result.fetched)
+        if result.outcome is not None:
+            ledger.record(webgazette, result.outcome, result.reason)
+        if result.archived_gazette is None:
+            local_cache.unpin(webgazette.store_path)
+        else:
+            # Other archivers could be archiving a gazette with the same
+            # unique_id, so uploads wait until the batch is flushed.
+            archive_gazette(result, archive_index,
+                            None if claims else uploader,
+                            batch, local_cache, metrics, pdb_on_error)
+
+        if len(batch) >= batch_size or \
+           time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            flush()
+            last_checkpoint = time.time()
+        elif local_cache.over_budget():
+            local_cache.evict()
+        if metrics_interval and time.time() - last_metrics >= metrics_interval:
+            metrics.write(metrics_path)
+            last_metrics = time.time()
+
+    flush()
+    uploader.close()
+    local_cache.log_stats()
+    metrics.count('local_cache', local_cache.hits, result='hit')
+    metrics.count('local_cache', local_cache.misses, result='miss')
+    metrics.count('local_cache_evicted_bytes', local_cache.evicted_bytes)
+    metrics.count('ledger_skipped', ledger.skipped)
+    logger.info("Skipped %d gazettes because of the ledger", ledger.skipped)
+    local_cache.close()
+    if claims:
+        claims.finish()
+    else:
+        # The run finished, so there's nothing to resume
+        checkpoint.clear()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        worker_state['inspection_cache'].close()
+    if prefetch_inspection_cache is not None:
+        prefetch_inspection_cache.close()
+    log_throughput(throughput, time.time() - start)
+    touch_inspections(inspection_cache_path, inspections_used)
+    evict_inspections(inspection_cache_path, inspection_stats)
+    metrics.write(metrics_path)
+    logger.info("Wrote metrics to %s.json and %s.prom", metrics_path, metrics_path)
+    webscraped_sesh.rollback()
+    engine.dispose()
 
 
-def archive(pdb_on_error):
-    tmpdir = mkdtemp(prefix='gazettes-archive')
+def rederive(pdb_on_error, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+             metrics_interval=None):
+    """
+    Work out the metadata of every archived gazette again with the current
+    rules, from the inspection cache and the scraped gazette's label, and
+    update only the columns that changed. Files are only moved in the
+    archive store if their archive_path changed.
+    """
     engine = create_engine(DB_URI)
     Session = sessionmaker(bind=engine)
     webscraped_sesh = Session()
-    scrapestore_get = get_function(WEB_SCRAPE_STORE_URI)
-    archive_put = put_function(ARCHIVE_STORE_URI)
-    cache_path = LOCAL_CACHE_STORE_PATH
-
-    for webgazette in webscraped_sesh.query(WebScrapedGazette)\
-                                     .filter(WebScrapedGazette.manually_ignored == False)\
-                                     .all():
-        logger.debug('------------------------------')
-        archive_sesh = Session()
-
-        # Get the PDF
-        cached_gazette_path = os.path.join(cache_path, webgazette.store_path)
-        if not os.path.exists(cached_gazette_path):
-            logger.debug("Cache MISS %s", webgazette.store_path)
-            scrapestore_get(webgazette.store_path, cached_gazette_path)
+    metrics = Metrics()
+    metrics_path = ARCHIVE_METRICS_PATH + '-rederive' if ARCHIVE_METRICS_PATH \
+                   else os.path.join(LOCAL_CACHE_STORE_PATH, 'rederive-metrics')
+    mover = ArchiveMover(ARCHIVE_STORE_URI, UPLOAD_THREADS, metrics)
+    inspection_cache_path = INSPECTION_CACHE_PATH or \
+                            os.path.join(LOCAL_CACHE_STORE_PATH,
+                                         'inspection-cache.sqlite')
+
+    with metrics.timer('db_lookup'):
+        archive_index = ArchiveIndex.load(webscraped_sesh)
+    logger.info("%d gazettes in the archive", len(archive_index))
+    with metrics.timer('db_lookup'):
+        volume_index = VolumeIndex.load(webscraped_sesh)
+    logger.info("%d date ranges with known volume numbers", len(volume_index))
+
+    local_cache = LocalCache(LOCAL_CACHE_STORE_PATH, LOCAL_CACHE_MAX_BYTES)
+    items = pinned(local_cache, stream_archived_gazettes(webscraped_sesh))
+
+    worker_args = (WEB_SCRAPE_STORE_URI,
+                   LOCAL_CACHE_STORE_PATH,
+                   inspection_cache_path,
+                   False,
+                   volume_index,
+                   pdb_on_error)
+    if workers > 1:
+        pool = Pool(workers, init_worker, worker_args)
+        results = imap_bounded(pool, rederive_gazette, items,
+                               workers * IN_FLIGHT_PER_WORKER)
+    else:
+        pool = None
+        init_worker(*worker_args)
+        results = imap(rederive_gazette, items)
+
+    throughput = defaultdict(lambda: [0, 0.0])
+    inspections_used = set()
+    start = time.time()
+    batch = []
+    last_metrics = time.time()
+
+    for result in results:
+        throughput[result.worker][0] += 1
+        throughput[result.worker][1] += result.elapsed
+        metrics.merge(result.metrics)
+        inspections_used.update(result.inspections_used)
+        webgazette = result.webgazette
+        if result.fetched is not None:
+            local_cache.used(webgazette.store_path, result.fetched)
+        local_cache.unpin(webgazette.store_path)
+
+        if result.changes is None:
+            metrics.count('rederived', result='error')
+        elif not result.changes:
+            metrics.count('rederived', result='unchanged')
         else:
-            logger.debug("Cache HIT %s", webgazette.store_path)
+            queue_update(result, archive_index, mover, batch, metrics)
+
+        if len(batch) >= batch_size:
+            flush_updates(Session, archive_index, mover, batch, metrics,
+                          pdb_on_error)
+            del batch[:]
+        if local_cache.over_budget():
+            local_cache.evict()
+        if metrics_interval and time.time() - last_metrics >= metrics_interval:
+            metrics.write(metrics_path)
+            last_metrics = time.time()
+
+    flush_updates(Session, archive_index, mover, batch, metrics, pdb_on_error)
+    mover.close()
+    local_cache.evict()
+    local_cache.log_stats()
+    local_cache.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        worker_state['inspection_cache'].close()
+    log_throughput(throughput, time.time() - start)
+    touch_inspections(inspection_cache_path, inspections_used)
+    summary = metrics.summary()['counters']
+    rederived = summary.get('rederived', {})
+    logger.info("Re-derived archived gazettes: %d updated (%d moved), "
+                "%d unchanged, %d collisions, %d errors",
+                rederived.get('result=updated', 0),
+                summary.get('moved', 0),
+                rederived.get('result=unchanged', 0),
+                rederived.get('result=collision', 0),
+                rederived.get('result=error', 0))
+    metrics.write(metrics_path)
+    logger.info("Wrote metrics to %s.json and %s.prom", metrics_path, metrics_path)
+    webscraped_sesh.rollback()
+    engine.dispose()
 
-        # Archive the PDF
-        try:
-            logger.debug("original_uri: %s", webgazette.original_uri)
-            cover_page_text = get_cover_page_text(cached_gazette_path)
-            if is_gazette_index(cover_page_text):
-                logger.debug("Ignoring index %r", webgazette.original_uri)
-                continue
 
-            pagecount = get_page_count(cached_gazette_path)
-            publication_title = get_publication_title(webgazette.referrer,
-                                                      webgazette.label)
-            publication_subtitle = get_publication_subtitle(webgazette.referrer,
-                                                            webgazette.label)
-            special_issue = get_special_issue(webgazette.referrer)
-            language_edition = get_language_edition(webgazette.referrer,
-                                                    webgazette.label)
-            issue_number = get_issue_number(webgazette.referrer, webgazette.label)
-            volume_number = get_volume_number(webgazette.referrer, cover_page_text)
-            jurisdiction_code = get_jurisdiction_code(webgazette.referrer,
-                                                      webgazette.label)
-            part_number = get_part_number(webgazette.referrer,
-                                          webgazette.label)
-            unique_id = get_unique_id(publication_title,
-                                      publication_subtitle,
-                                      jurisdiction_code,
-                                      volume_number,
-                                      issue_number,
-                                      part_number,
-                                      language_edition)
-            archive_path = get_archive_path(unique_id,
-                                            jurisdiction_code,
-                                            special_issue,
-                                            webgazette.published_date)
-            archived_gazette = ArchivedGazette.fromDict({
-                'original_uri': webgazette.original_uri,
-                'archive_path': archive_path,
-                'publication_title': publication_title,
-                'publication_subtitle': publication_subtitle,
-                'special_issue': special_issue,
-                'language_edition': language_edition,
-                'issue_number': issue_number,
-                'volume_number': volume_number,
-                'jurisdiction_code': jurisdiction_code,
-                'publication_date': webgazette.published_date,
-                'unique_id': unique_id,
-                'pagecount': pagecount,
-            })
-
-            existing_archived_gazette = archive_sesh \
-                                       .query(ArchivedGazette)\
-                                       .filter(ArchivedGazette.unique_id
-                                               == archived_gazette.unique_id)\
-                                       .first()
-            if existing_archived_gazette:
-                if existing_archived_gazette.original_uri == webgazette.original_uri:
-                    logger.debug("%r exists in the archive", archived_gazette.unique_id)
-                else:
-                    logger.error("Skipping %r because another ArchivedGazette " \
-                                 "exists with the same unique_id (%r)",
-                                 webgazette,
-                                 existing_archived_gazette)
-            else:
-                logger.debug("Archiving %r", archived_gazette.unique_id)
-                archive_put(cached_gazette_path, archived_gazette.archive_path)
-                archive_sesh.add(archived_gazette)
-                logger.debug("Done")
+def stream_archived_gazettes(session):
+    """
+    Yields (archived dict, ScrapedGazette) for every ArchivedGazette and the
+    scraped gazette it was archived from, in ArchivedGazette id order.
+    """
+    columns = [ArchivedGazette.id] + \
+              [getattr(ArchivedGazette, column) for column in DERIVED_COLUMNS] + \
+              [getattr(WebScrapedGazette, field) for field in ScrapedGazette._fields]
+    query = session.query(*columns)\
+                   .join(WebScrapedGazette,
+                         WebScrapedGazette.original_uri
+                         == ArchivedGazette.original_uri)\
+                   .order_by(ArchivedGazette.id)\
+                   .yield_per(STREAM_BATCH_SIZE)
+    archived_fields = ('id',) + DERIVED_COLUMNS
+    for row in query:
+        yield (dict(zip(archived_fields, row[:len(archived_fields)])),
+               ScrapedGazette._make(row[len(archived_fields):]))
+
+
+def pinned(local_cache, items):
+    for archived, webgazette in items:
+        local_cache.pin(webgazette.store_path)
+        yield archived, webgazette
+
+
+def queue_update(result, archive_index, mover, batch, metrics):
+    """
+    Add a re-derived gazette whose metadata changed to the batch to be
+    updated, unless its new unique_id belongs to another archived gazette.
+    If its archive_path changed, a copy of it at the new path is started.
+    """
+    archived = result.archived
+    changes = result.changes
+    original_uri = result.webgazette.original_uri
+    if 'unique_id' in changes:
+        existing_original_uri = archive_index.get(changes['unique_id'])
+        if existing_original_uri is not None:
+            metrics.count('rederived', result='collision')
+            logger.error("Not updating %r because another ArchivedGazette "
+                         "exists with its new unique_id (%r from %r)",
+                         result.webgazette, changes['unique_id'],
+                         existing_original_uri)
+            return
+        archive_index.remove(archived['unique_id'])
+        archive_index.add(changes['unique_id'], original_uri)
+    if 'archive_path' in changes:
+        copy = mover.copy(archived['archive_path'], changes['archive_path'])
+    else:
+        copy = None
+    logger.debug("Updating %s of %r", ', '.join(sorted(changes)),
+                 archived['unique_id'])
+    batch.append((result, copy))
+
+
+def flush_updates(Session, archive_index, mover, batch, metrics, pdb_on_error):
+    """
+    Wait for the copies of a batch of (re-derived gazette, copy) tuples,
+    update the rows of the ones that were copied, and then delete their old
+    files. Files are only deleted once the rows pointing at their new paths
+    are committed.
+    """
+    copied = []
+    for result, copy in batch:
+        try:
+            if copy is not None:
+                copy.get()
+            copied.append(result)
         except Exception, e:
-            logger.exception("Error for %r", webgazette)
+            undo_rename(archive_index, result)
+            metrics.count('errors', stage='move', exception=type(e).__name__)
+            logger.exception("Error moving %r", result.webgazette)
             if pdb_on_error:
                 ype, value, tb = sys.exc_info()
                 pdb.post_mortem(tb)
+    if not copied:
+        return
 
-        archive_sesh.commit()
-    webscraped_sesh.rollback()
-    engine.dispose()
+    archive_sesh = Session()
+    try:
+        updated = update_archived(archive_sesh, copied, metrics, pdb_on_error)
+    finally:
+        archive_sesh.close()
+    for result in copied:
+        archive_path = result.changes.get('archive_path')
+        if result.archived['id'] in updated:
+            if archive_path is not None:
+                mover.delete(result.archived['archive_path'])
+                metrics.count('moved')
+        else:
+            undo_rename(archive_index, result)
+            if archive_path is not None:
+                mover.delete(archive_path)
 
 
-def get_cover_page_text(cached_gazette_path):
-    result = os.system("pdftotext -f 1 -l 1 %s" % cached_gazette_path)
-    if result == 0:
-        pre, ext = os.path.splitext(cached_gazette_path)
-        with open(pre + '.txt', 'r') as f:
-            return f.read()
-    else:
-        raise Exception("pdf_to_text exit status %r" % result)
+def undo_rename(archive_index, result):
+    if 'unique_id' in result.changes:
+        archive_index.remove(result.changes['unique_id'])
+        archive_index.add(result.archived['unique_id'],
+                          result.webgazette.original_uri)
 
 
-def get_page_count(cached_gazette_path):
-    info = subprocess.check_output(['pdfinfo', cached_gazette_path])
-    regex = 'Pages:\s+(\d+)\s'
+def update_archived(archive_sesh, results, metrics, pdb_on_error):
+    """
+    Update the changed columns of re-derived gazettes, with one executemany
+    per set of changed columns. If that fails, the rows are retried one at a
+    time so that one bad row doesn't lose the rest. Returns the set of ids
+    of the rows that were updated.
+    """
+    by_columns = defaultdict(list)
+    for result in results:
+        by_columns[tuple(sorted(result.changes))].append(result)
     try:
-        return int(re.search(regex, info).group(1))
-    except AttributeError:
-        raise Exception("Can't find page count in %r" % info)
+        with metrics.timer('commit'):
+            for columns, group in by_columns.iteritems():
+                archive_sesh.execute(update_statement(columns),
+                                     [update_params(result) for result in group])
+            archive_sesh.commit()
+        metrics.count('rederived', len(results), result='updated')
+        return set(result.archived['id'] for result in results)
+    except Exception, e:
+        archive_sesh.rollback()
+        logger.warning("Batch update of %d gazettes failed (%s). "
+                       "Retrying one at a time.", len(results), e)
+
+    updated = set()
+    for result in results:
+        try:
+            with metrics.timer('commit'):
+                archive_sesh.execute(update_statement(tuple(sorted(result.changes))),
+                                     update_params(result))
+                archive_sesh.commit()
+            metrics.count('rederived', result='updated')
+            updated.add(result.archived['id'])
+        except Exception, e:
+            archive_sesh.rollback()
+            metrics.count('errors', stage='update', exception=type(e).__name__)
+            logger.exception("Error updating %r", result.webgazette)
+            if pdb_on_error:
+                ype, value, tb = sys.exc_info()
+                pdb.post_mortem(tb)
+    return updated
 
 
-def is_gazette_index(cover_page_text):
-    return 'INDEX OF THE' in cover_page_text
+def update_statement(columns):
+    # Bind parameters can't have the names of the columns they set
+    table = ArchivedGazette.__table__
+    return table.update()\
+                .where(table.c.id == bindparam('_id'))\
+                .values(dict((column, bindparam('_' + column))
+                             for column in columns))
 
 
-def get_publication_title(referrer, label):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        if url.path in {
-                '/Gazettes/Pages/Provincial-Gazettes-Eastern-Cape.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Gauteng.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-KwaZulu-Natal.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Limpopo.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Mpumalanga.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-North-West.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Northern-Cape.aspx',
-        }:
-            return 'Provincial Gazette'
-        elif url.path in {
-                '/Gazettes/Pages/Published-Legal-Gazettes.aspx',
-                '/Gazettes/Pages/Published-National-Government-Gazettes.aspx',
-                '/Gazettes/Pages/Published-National-Regulation-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Separate-Gazettes.aspx',
-                '/Gazettes/Pages/Road-Access-Permits.aspx',
-        }:
-            return 'Government Gazette'
-        elif url.path == '/Gazettes/Pages/Published-Liquor-Licenses.aspx':
-            if ('NCape' in label or
-                'NKaap' in label or
-                'Northern Cape' in label or
-                'gaut' in label.lower()):
-                return 'Provincial Gazette'
-            elif 'National' in label:
-                return 'Government Gazette'
+def update_params(result):
+    params = dict(('_' + column, value)
+                  for column, value in result.changes.iteritems())
+    params['_id'] = result.archived['id']
+    return params
+
+
+def archive_gazette(result, archive_index, uploader, batch, local_cache,
+                    metrics, pdb_on_error):
+    """
+    Start uploading a processed gazette and add it to the batch to be
+    inserted, unless it or another gazette with its unique_id is already in
+    the archive. If uploader is None the upload is left to whatever flushes
+    the batch.
+    """
+    webgazette = result.webgazette
+    uploading = False
+    try:
+        archived_gazette = ArchivedGazette.fromDict(result.archived_gazette)
+        existing_original_uri = archive_index.get(archived_gazette.unique_id)
+        if existing_original_uri:
+            if existing_original_uri == webgazette.original_uri:
+                logger.debug("%r exists in the archive", archived_gazette.unique_id)
+                metrics.count('already_archived')
             else:
-                raise Exception("unknon jurisdiction for '%s'" % label)
-        elif url.path == '/Gazettes/Pages/Published-Tender-Bulletin.aspx':
-            return 'Tender Bulletin'
+                metrics.count('collisions')
+                logger.error("Skipping %r because another ArchivedGazette " \
+                             "exists with the same unique_id (%r from %r)",
+                             webgazette,
+                             archived_gazette.unique_id,
+                             existing_original_uri)
         else:
-            raise Exception("unknown path '%s'" % url.path)
-    elif url.hostname in {
-            'www.westerncape.gov.za'
-    }:
-        return 'Provincial Gazette'
-    else:
-        raise Exception
+            logger.debug("Archiving %r", archived_gazette.unique_id)
+            archive_index.add(archived_gazette.unique_id,
+                              webgazette.original_uri)
+            if uploader is None:
+                upload = None
+            else:
+                cached_gazette_path = os.path.join(LOCAL_CACHE_STORE_PATH,
+                                                   webgazette.store_path)
+                upload = uploader.upload(cached_gazette_path,
+                                         webgazette.store_path,
+                                         archived_gazette.archive_path)
+            batch.append((webgazette, result.archived_gazette, upload))
+            uploading = True
+    except Exception, e:
+        metrics.count('errors', stage='archive', exception=type(e).__name__)
+        logger.exception("Error for %r", webgazette)
+        if pdb_on_error:
+            ype, value, tb = sys.exc_info()
+            pdb.post_mortem(tb)
+    if not uploading:
+        local_cache.unpin(webgazette.store_path)
 
 
-def get_publication_subtitle(referrer, label):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        if url.path == '/Gazettes/Pages/Published-National-Regulation-Gazettes.aspx':
-            return 'Regulation Gazette'
-        elif url.path == '/Gazettes/Pages/Published-Legal-Gazettes.aspx':
-            regex = 'Legal? ?([A-C])'
-            return "Legal Gazette %s" % re.search(regex, label).group(1)
-        elif url.path in {
-                '/Gazettes/Pages/Provincial-Gazettes-Eastern-Cape.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Gauteng.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-KwaZulu-Natal.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Limpopo.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Mpumalanga.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-North-West.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Northern-Cape.aspx',
-                '/Gazettes/Pages/Published-Legal-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Liquor-Licenses.aspx',
-                '/Gazettes/Pages/Published-National-Government-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Separate-Gazettes.aspx',
-                '/Gazettes/Pages/Road-Access-Permits.aspx',
-                '/Gazettes/Pages/Published-Tender-Bulletin.aspx',
-        }:
-            return None
+def is_known_duplicate(webgazette, archive_index, volume_index, metrics):
+    """
+    Whether another gazette is already archived under the unique_id this
+    one would get. This is worked out from the gazette's label and, if its
+    publication has volume numbers, the volume its publication date falls
+    in, so that it isn't fetched and inspected only to be skipped.
+    """
+    unique_id = infer_unique_id(webgazette, volume_index)
+    if unique_id is None:
+        return False
+    existing_original_uri = archive_index.get(unique_id)
+    if existing_original_uri is None:
+        return False
+    metrics.count('collisions')
+    logger.error("Skipping %r because another ArchivedGazette " \
+                 "exists with the same unique_id (%r from %r)",
+                 webgazette, unique_id, existing_original_uri)
+    return True
+
+
+def infer_unique_id(webgazette, volume_index):
+    """
+    The unique_id of a gazette without looking at the PDF, or None if it
+    can't be worked out that way.
+    """
+    try:
+        metadata = derive_metadata(webgazette.referrer, webgazette.label)
+        if has_volume_number(webgazette.referrer):
+            volume_number = volume_index.get(metadata['publication_title'],
+                                             metadata['jurisdiction_code'],
+                                             webgazette.published_date)
+            if volume_number is None:
+                return None
         else:
-            raise Exception("unknown path '%s'" % url.path)
-    elif url.hostname in {
-            'www.westerncape.gov.za'
-    }:
+            volume_number = None
+    except Exception:
+        # Left for the worker to report
         return None
-    else:
-        raise Exception
+    return get_unique_id(metadata['publication_title'],
+                         metadata['publication_subtitle'],
+                         metadata['jurisdiction_code'],
+                         volume_number,
+                         metadata['issue_number'],
+                         metadata['part_number'],
+                         metadata['language_edition'])
+
+
+def stream_gazettes(query):
+    # yield_per streams rows from a server-side cursor so that the first
+    # gazette is processed without loading the whole table first.
+    query = query.order_by(WebScrapedGazette.id)\
+                 .yield_per(STREAM_BATCH_SIZE)
+    return (ScrapedGazette._make(row) for row in query)
+
+
+class ArchiveIndex(object):
+    """
+    The unique_id and original_uri of every ArchivedGazette, loaded once so
+    that "exists in the archive" and unique_id collisions can be decided
+    without a query per gazette. Gazettes are added as soon as they are
+    picked for archival, before they're uploaded, so that two gazettes in
+    the same run with the same unique_id are caught too.
+    """
+
+    def __init__(self, original_uris_by_unique_id):
+        self.original_uris_by_unique_id = original_uris_by_unique_id
+        self.original_uris = set(original_uris_by_unique_id.itervalues())
+
+    @classmethod
+    def load(cls, session):
+        return cls(dict(session.query(ArchivedGazette.unique_id,
+                                      ArchivedGazette.original_uri)))
+
+    def __len__(self):
+        return len(self.original_uris_by_unique_id)
+
+    def get(self, unique_id):
+        return self.original_uris_by_unique_id.get(unique_id)
 
+    def is_archived(self, webgazette):
+        if webgazette.original_uri in self.original_uris:
+            logger.debug("%r exists in the archive", webgazette.original_uri)
+            return True
+        return False
 
-def get_special_issue(referrer):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        if url.path == '/Gazettes/Pages/Published-Liquor-Licenses.aspx':
-            return 'Liquor Licenses'
-        elif url.path == '/Gazettes/Pages/Road-Access-Permits.aspx':
-            return 'Road Carrier Permits'
-        elif url.path in {
-                '/Gazettes/Pages/Provincial-Gazettes-Eastern-Cape.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Gauteng.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-KwaZulu-Natal.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Limpopo.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Mpumalanga.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-North-West.aspx',
-                '/Gazettes/Pages/Provincial-Gazettes-Northern-Cape.aspx',
-                '/Gazettes/Pages/Published-Legal-Gazettes.aspx',
-                '/Gazettes/Pages/Published-National-Government-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Separate-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Legal-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Tender-Bulletin.aspx',
-                '/Gazettes/Pages/Published-National-Regulation-Gazettes.aspx',
-        }:
+    def add(self, unique_id, original_uri):
+        self.original_uris_by_unique_id[unique_id] = original_uri
+        self.original_uris.add(original_uri)
+
+    def remove(self, unique_id):
+        original_uri = self.original_uris_by_unique_id.pop(unique_id)
+        self.original_uris.discard(original_uri)
+
+
+class Checkpoint(object):
+    """
+    The id of the last web_scraped_gazette row an interrupted run finished
+    with, so that a resumed run can start after it. It is replaced
+    atomically so that a crash while saving leaves the previous checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['last_id']
+        except IOError:
             return None
-        else:
-            raise Exception
-    elif url.hostname in {
-            'www.westerncape.gov.za'
-    }:
-        return None
-    else:
-        raise Exception
 
+    def save(self, last_id):
+        tmp_path = '%s.tmp-%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_id': last_id, 'saved_at': time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
 
-def get_part_number(referrer, label):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        regex = '(Part|P) ?(\d+)$'
-    elif url.hostname == 'www.westerncape.gov.za':
-        return None
-    else:
-        raise Exception
-    match = re.search(regex, label)
-    if match:
-        return int(match.group(2))
-    else:
-        return None
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
-def get_language_edition(referrer, label):
+def flush_batch(Session, archive_index, batch, metrics, pdb_on_error):
     """
-    'Provincial Gazette Extraordinary 6445a - 18 June 2007'
-    'Provincial Gazette Extraordinary 6445e - 18 June 2007'
+    Wait for the uploads of a batch of (webgazette, archived gazette dict,
+    upload) tuples and insert the ones that were uploaded. Rows are only
+    committed once their upload has succeeded.
     """
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        return None
-    elif url.hostname == 'www.westerncape.gov.za':
-        regex = '^[a-zA-Z ]+\d+([ae]) -'
-    else:
-        raise Exception
-    match = re.search(regex, label)
-    if match:
-        return {
-            'a': 'AF',
-            'e': 'EN',
-        }[match.group(1)]
-    else:
-        return None
+    uploaded = []
+    for webgazette, archived_gazette, upload in batch:
+        try:
+            upload.get()
+            uploaded.append((webgazette, archived_gazette))
+        except Exception, e:
+            archive_index.remove(archived_gazette['unique_id'])
+            metrics.count('errors', stage='upload', exception=type(e).__name__)
+            logger.exception("Error uploading %r", webgazette)
+            if pdb_on_error:
+                ype, value, tb = sys.exc_info()
+                pdb.post_mortem(tb)
+    if not uploaded:
+        return
+
+    archive_sesh = Session()
+    try:
+        insert_archived(archive_sesh, archive_index, uploaded, metrics,
+                        pdb_on_error)
+    finally:
+        archive_sesh.close()
 
 
-def get_issue_number(referrer, label):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        regex = '^(\d+)[_ ]\w'
-    elif url.hostname == 'www.westerncape.gov.za':
-        regex = '^[a-zA-Z ]+(\d+)[ae]? ?(Extraordinary )?-'
-    else:
-        raise Exception
+def flush_locked_batch(Session, archive_index, uploader, batch, metrics,
+                       pdb_on_error):
+    """
+    flush_batch for when other archivers are archiving into the same
+    database. The unique_ids of the batch are locked with Postgres advisory
+    locks and checked against the database again before the batch is
+    uploaded, so that an archiver never overwrites the file another one
+    archived under the same unique_id. The locks are held until the rows
+    are committed.
+    """
+    if not batch:
+        return
+    archive_sesh = Session()
     try:
-        return int(re.search(regex, label).group(1))
-    except AttributeError:
-        raise Exception("Can't find issue number in '%s'" % label)
+        unique_ids = sorted(set(archived_gazette['unique_id']
+                                for webgazette, archived_gazette, upload
+                                in batch))
+        with metrics.timer('db_lookup'):
+            # Always locked in the same order so archivers can't deadlock
+            for unique_id in unique_ids:
+                archive_sesh.execute(text("SELECT pg_advisory_xact_lock(hashtext(:unique_id))"),
+                                     {'unique_id': unique_id})
+            existing = dict(archive_sesh.query(ArchivedGazette.unique_id,
+                                               ArchivedGazette.original_uri)
+                            .filter(ArchivedGazette.unique_id.in_(unique_ids)))
+
+        uploads = []
+        for webgazette, archived_gazette, upload in batch:
+            unique_id = archived_gazette['unique_id']
+            existing_original_uri = existing.get(unique_id)
+            if existing_original_uri is None:
+                cached_gazette_path = os.path.join(LOCAL_CACHE_STORE_PATH,
+                                                   webgazette.store_path)
+                uploads.append((webgazette, archived_gazette,
+                                uploader.upload(cached_gazette_path,
+                                                webgazette.store_path,
+                                                archived_gazette['archive_path'])))
+                continue
+            # Archived by another archiver since this one started
+            archive_index.remove(unique_id)
+            archive_index.add(unique_id, existing_original_uri)
+            if existing_original_uri == webgazette.original_uri:
+                logger.debug("%r exists in the archive", unique_id)
+                metrics.count('already_archived')
+            else:
+                metrics.count('collisions')
+                logger.error("Skipping %r because another ArchivedGazette " \
+                             "exists with the same unique_id (%r from %r)",
+                             webgazette, unique_id, existing_original_uri)
+
+        uploaded = []
+        for webgazette, archived_gazette, upload in uploads:
+            try:
+                upload.get()
+                uploaded.append((webgazette, archived_gazette))
+            except Exception, e:
+                archive_index.remove(archived_gazette['unique_id'])
+                metrics.count('errors', stage='upload', exception=type(e).__name__)
+                logger.exception("Error uploading %r", webgazette)
+                if pdb_on_error:
+                    ype, value, tb = sys.exc_info()
+                    pdb.post_mortem(tb)
+        if uploaded:
+            insert_archived(archive_sesh, archive_index, uploaded, metrics,
+                            pdb_on_error)
+        else:
+            archive_sesh.commit()
+    finally:
+        archive_sesh.rollback()
+        archive_sesh.close()
+
+
+def insert_archived(archive_sesh, archive_index, uploaded, metrics,
+                    pdb_on_error):
+    """
+    Insert (webgazette, archived gazette dict) tuples in one multi-row
+    insert. If that fails, the rows are retried one at a time so that one
+    bad row doesn't lose the rest.
+    """
+    insert = ArchivedGazette.__table__.insert()
+    try:
+        with metrics.timer('commit'):
+            archive_sesh.execute(insert.values([archived_gazette for webgazette,
+                                                archived_gazette in uploaded]))
+            archive_sesh.commit()
+        metrics.count('archived', len(uploaded))
+        logger.debug("Archived %d gazettes", len(uploaded))
+    except Exception, e:
+        archive_sesh.rollback()
+        logger.warning("Batch insert of %d gazettes failed (%s). "
+                       "Retrying one at a time.", len(uploaded), e)
+        for webgazette, archived_gazette in uploaded:
+            try:
+                with metrics.timer('commit'):
+                    archive_sesh.execute(insert.values(archived_gazette))
+                    archive_sesh.commit()
+                metrics.count('archived')
+            except Exception, e:
+                archive_sesh.rollback()
+                archive_index.remove(archived_gazette['unique_id'])
+                metrics.count('errors', stage='insert', exception=type(e).__name__)
+                logger.exception("Error for %r", webgazette)
+                if pdb_on_error:
+                    ype, value, tb = sys.exc_info()
+                    pdb.post_mortem(tb)
+
+
+class Uploader(object):
+    """
+    Uploads files to the archive store in a pool of threads so that
+    extraction can carry on while uploads are in flight. Each thread keeps
+    its own connection to the store for all its uploads.
+
+    If the scrape store and the archive store are both in S3, files are
+    copied from the scrape store within S3 instead of being uploaded.
+    """
+
+    def __init__(self, scrape_store_uri, archive_store_uri, threads, metrics):
+        self.scrape_store_uri = scrape_store_uri
+        self.archive_store_uri = archive_store_uri
+        self.metrics = metrics
+        self.pool = ThreadPool(threads)
+        self.thread_state = threading.local()
+
+    def upload(self, cached_gazette_path, store_path, archive_path):
+        """
+        Start archiving a gazette. Returns an AsyncResult whose get() waits
+        for the upload and raises if it failed.
+        """
+        return self.pool.apply_async(self.put, (cached_gazette_path,
+                                                store_path,
+                                                archive_path))
+
+    def put(self, cached_gazette_path, store_path, archive_path):
+        if not hasattr(self.thread_state, 'archive_put'):
+            self.thread_state.archive_copy = copy_function(self.scrape_store_uri,
+                                                           self.archive_store_uri)
+            self.thread_state.archive_put = put_function(self.archive_store_uri)
+        if self.thread_state.archive_copy:
+            with self.metrics.timer('archive_copy'):
+                self.thread_state.archive_copy(store_path, archive_path)
+        else:
+            with self.metrics.timer('archive_put'):
+                self.thread_state.archive_put(cached_gazette_path, archive_path)
+            self.metrics.count('bytes_uploaded',
+                               os.path.getsize(cached_gazette_path))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
 
-def get_volume_number(referrer, cover_page_text):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        regex = 'Vol.\x00? ?(\d+)'
+class ArchiveMover(object):
+    """
+    Copies files to new paths within the archive store, and deletes them
+    from their old paths, in a pool of threads. Each thread keeps its own
+    connection to the store.
+    """
+
+    def __init__(self, archive_store_uri, threads, metrics):
+        self.archive_store_uri = archive_store_uri
+        self.metrics = metrics
+        self.pool = ThreadPool(threads)
+        self.thread_state = threading.local()
+
+    def copy(self, from_path, to_path):
+        """
+        Start copying a file. Returns an AsyncResult whose get() waits for
+        the copy and raises if it failed.
+        """
+        return self.pool.apply_async(self.run_copy, (from_path, to_path))
+
+    def delete(self, path):
+        """Start deleting a file. Failures are only logged."""
+        return self.pool.apply_async(self.run_delete, (path,))
+
+    def connect(self):
+        if not hasattr(self.thread_state, 'archive_copy_within'):
+            self.thread_state.archive_copy_within = copy_within_function(self.archive_store_uri)
+            self.thread_state.archive_delete = delete_function(self.archive_store_uri)
+
+    def run_copy(self, from_path, to_path):
+        self.connect()
+        with self.metrics.timer('archive_copy_within'):
+            self.thread_state.archive_copy_within(from_path, to_path)
+
+    def run_delete(self, path):
+        self.connect()
         try:
-            return int(re.search(regex, cover_page_text).group(1))
-        except AttributeError:
-            raise NeedsOCRError("Can't find volume number in %r" % cover_page_text)
-    elif url.hostname == 'www.westerncape.gov.za':
-        return None
-    else:
-        raise Exception
+            with self.metrics.timer('archive_delete'):
+                self.thread_state.archive_delete(path)
+        except Exception, e:
+            self.metrics.count('errors', stage='delete', exception=type(e).__name__)
+            logger.warning("Error deleting %s from the archive: %s", path, e)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class Prefetcher(object):
+    """
+    Downloads the gazettes that are about to be processed into the local
+    cache in a pool of threads while the current ones are being processed.
+
+    At most depth gazettes are looked ahead at, and no new downloads are
+    started while more than max_bytes are being downloaded or waiting to be
+    processed. The size of a file isn't known until it has been downloaded,
+    so the average size of the downloads so far is reserved when a download
+    starts, and swapped for its actual size when it finishes. If
+    needs_download is given, gazettes for which it returns False aren't
+    downloaded.
+    """
+
+    def __init__(self, scrape_store_uri, cache_path, depth, max_bytes,
+                 metrics, needs_download=None, threads=PREFETCH_THREADS):
+        self.scrape_store_uri = scrape_store_uri
+        self.cache_path = cache_path
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.needs_download = needs_download
+        self.threads = threads
+        self.thread_state = threading.local()
+        self.lock = threading.Lock()
+        # Reserved for downloads in progress plus the sizes of finished
+        # downloads that haven't been processed yet
+        self.waiting_bytes = 0
+        self.downloads = 0
+        self.downloaded_bytes = 0
+
+    def __call__(self, webgazettes):
+        webgazettes = iter(webgazettes)
+        pool = ThreadPool(min(self.threads, self.depth))
+        window = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(window) < self.depth \
+                      and self.waiting_bytes < self.max_bytes:
+                    try:
+                        webgazette = next(webgazettes)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    cached_gazette_path = os.path.join(self.cache_path,
+                                                       webgazette.store_path)
+                    if os.path.exists(cached_gazette_path) or \
+                       (self.needs_download and
+                        not self.needs_download(webgazette)):
+                        window.append((webgazette, None))
+                    else:
+                        reserved = self.reserve()
+                        download = pool.apply_async(self.download,
+                                                    (webgazette.store_path,
+                                                     cached_gazette_path,
+                                                     reserved))
+                        window.append((webgazette, download))
+                if not window:
+                    break
+
+                webgazette, download = window.popleft()
+                if download is not None:
+                    try:
+                        size = download.get()
+                        with self.lock:
+                            self.waiting_bytes -= size
+                    except Exception, e:
+                        # Leave it to the worker to try again and report it
+                        self.metrics.count('errors', stage='prefetch',
+                                           exception=type(e).__name__)
+                        logger.debug("Error prefetching %r: %s", webgazette, e)
+                yield webgazette
+        finally:
+            pool.close()
+            pool.join()
+
+    def reserve(self):
+        with self.lock:
+            if self.downloads:
+                reserved = self.downloaded_bytes // self.downloads
+            else:
+                reserved = PREFETCH_EXPECTED_BYTES
+            self.waiting_bytes += reserved
+        return reserved
+
+    def download(self, store_path, cached_gazette_path, reserved):
+        size = 0
+        try:
+            # boto connections aren't shared between threads
+            if not hasattr(self.thread_state, 'scrapestore_get'):
+                self.thread_state.scrapestore_get = get_function(self.scrape_store_uri)
+            with self.metrics.timer('scrapestore_get'):
+                size = fetch_to_cache(self.thread_state.scrapestore_get,
+                                      store_path,
+                                      cached_gazette_path)
+        finally:
+            with self.lock:
+                self.waiting_bytes += size - reserved
+                if size:
+                    self.downloads += 1
+                    self.downloaded_bytes += size
+        self.metrics.count('bytes_downloaded', size)
+        return size
+
+
+def imap_bounded(pool, func, iterable, window):
+    """
+    Like pool.imap, but iterable is consumed in the calling thread and at
+    most window items are handed to the pool before their results are
+    taken. Pool.imap consumes its input in a separate thread as fast as it
+    can, which would read the whole table into the pool's task queue and
+    use the database connection from another thread.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def init_worker(scrape_store_uri, cache_path, inspection_cache_path,
+                server_side_copy, volume_index, pdb_on_error):
+    worker_state['scrapestore_get'] = get_function(scrape_store_uri)
+    worker_state['cache_path'] = cache_path
+    worker_state['inspection_cache'] = InspectionCache(
+        inspection_cache_path, INSPECTION_CACHE_MAX_ENTRIES)
+    worker_state['server_side_copy'] = server_side_copy
+    worker_state['volume_index'] = volume_index
+    worker_state['pdb_on_error'] = pdb_on_error
+
+
+def rederive_gazette(item):
+    """
+    Work out the metadata of an archived gazette again from its inspection
+    and its scraped gazette, and compare it to what's in the database. The
+    PDF is only fetched and inspected if it isn't in the inspection cache.
+    """
+    archived, webgazette = item
+    start = time.time()
+    changes = None
+    fetched = None
+    metrics = worker_state['metrics'] = Metrics()
+
+    try:
+        inspection = worker_state['inspection_cache']\
+                     .get_by_store_path(webgazette.store_path)
+        inspection_cached = inspection is not None
+        if inspection is None:
+            cached_gazette_path = os.path.join(worker_state['cache_path'],
+                                               webgazette.store_path)
+            fetched = not os.path.exists(cached_gazette_path)
+            if fetched:
+                with metrics.timer('scrapestore_get'):
+                    size = fetch_to_cache(worker_state['scrapestore_get'],
+                                          webgazette.store_path,
+                                          cached_gazette_path)
+                metrics.count('bytes_downloaded', size)
+            inspection, inspection_cached = inspect_gazette(cached_gazette_path,
+                                                            webgazette.store_path)
+        metrics.count('inspection_cache',
+                      result='hit' if inspection_cached else 'miss')
+        if inspection.is_index:
+            raise Exception("Archived gazette looks like an index")
+        with metrics.timer('derive_metadata'):
+            rederived = get_archived_gazette(webgazette, inspection)
+            ArchivedGazette.fromDict(rederived)
+        changes = dict((column, rederived[column]) for column in DERIVED_COLUMNS
+                       if rederived[column] != archived[column])
+    except Exception, e:
+        metrics.count('errors', stage='rederive', exception=type(e).__name__)
+        logger.exception("Error re-deriving %r", webgazette)
+        if worker_state['pdb_on_error']:
+            ype, value, tb = sys.exc_info()
+            pdb.post_mortem(tb)
+
+    elapsed = time.time() - start
+    metrics.observe('rederive_gazette', elapsed)
+    return RederivedGazette(archived,
+                            webgazette,
+                            changes,
+                            fetched,
+                            worker_state['inspection_cache'].pop_used(),
+                            os.getpid(),
+                            elapsed,
+                            metrics.snapshot())
 
 
-def get_jurisdiction_code(referrer, label):
-    url = urlparse(referrer)
-    if url.hostname == 'www.gpwonline.co.za':
-        if url.path == '/Gazettes/Pages/Provincial-Gazettes-Eastern-Cape.aspx':
-            return 'ZA-EC'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-Gauteng.aspx':
-            return 'ZA-GT'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-KwaZulu-Natal.aspx':
-            return 'ZA-NL'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-Limpopo.aspx':
-            return 'ZA-LP'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-Mpumalanga.aspx':
-            return 'ZA-MP'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-North-West.aspx':
-            return 'ZA-NW'
-        elif url.path == '/Gazettes/Pages/Provincial-Gazettes-Northern-Cape.aspx':
-            return 'ZA-NC'
-        elif url.path in {
-                '/Gazettes/Pages/Published-Legal-Gazettes.aspx',
-                '/Gazettes/Pages/Published-National-Government-Gazettes.aspx',
-                '/Gazettes/Pages/Published-National-Regulation-Gazettes.aspx',
-                '/Gazettes/Pages/Published-Separate-Gazettes.aspx',
-                '/Gazettes/Pages/Road-Access-Permits.aspx',
-                '/Gazettes/Pages/Published-Tender-Bulletin.aspx',
-        }:
-            return 'ZA'
-        elif url.path == '/Gazettes/Pages/Published-Liquor-Licenses.aspx':
-            if ('NCape' in label or
-                'NKaap' in label or
-                'Northern Cape' in label):
-                return 'ZA-NC'
-            elif 'gaut' in label.lower():
-                return 'ZA-GT'
-            elif 'National' in label:
-                return 'ZA'
+def process_gazette(webgazette):
+    """
+    Fetch a gazette into the local cache and work out its archive metadata.
+    This is the part of archival that can happen in parallel - checking
+    for existing ArchivedGazettes and adding new ones happens in the main
+    process.
+    """
+    start = time.time()
+    logger.debug('------------------------------')
+    archived_gazette = None
+    inspection_cached = None
+    fetched = None
+    outcome = None
+    reason = None
+    stage = 'inspect'
+    metrics = worker_state['metrics'] = Metrics()
+
+    # Get the PDF
+    cached_gazette_path = os.path.join(worker_state['cache_path'],
+                                       webgazette.store_path)
+    try:
+        inspection = None
+        if worker_state['server_side_copy']:
+            # The PDF itself is only needed to inspect it
+            inspection = worker_state['inspection_cache']\
+                         .get_by_store_path(webgazette.store_path)
+        if inspection is not None:
+            logger.debug("Inspection HIT %s", webgazette.store_path)
+            inspection_cached = True
+        else:
+            fetched = not os.path.exists(cached_gazette_path)
+            if fetched:
+                logger.debug("Cache MISS %s", webgazette.store_path)
+                with metrics.timer('scrapestore_get'):
+                    size = fetch_to_cache(worker_state['scrapestore_get'],
+                                          webgazette.store_path,
+                                          cached_gazette_path)
+                metrics.count('bytes_downloaded', size)
             else:
-                raise Exception("unknon jurisdiction for '%s'" % label)
+                logger.debug("Cache HIT %s", webgazette.store_path)
+            inspection, inspection_cached = inspect_gazette(cached_gazette_path,
+                                                            webgazette.store_path)
+        metrics.count('inspection_cache',
+                      result='hit' if inspection_cached else 'miss')
+
+        logger.debug("original_uri: %s", webgazette.original_uri)
+        if inspection.is_index:
+            logger.debug("Ignoring index %r", webgazette.original_uri)
+            metrics.count('indexes_skipped')
+            outcome = 'index'
         else:
-            raise Exception("unknown path '%s'" % url.path)
-    elif url.hostname in {
-            'www.westerncape.gov.za'
-    }:
-        return 'ZA-WC'
+            stage = 'metadata'
+            with metrics.timer('derive_metadata'):
+                archived_gazette = get_archived_gazette(webgazette, inspection)
+    except Exception, e:
+        outcome = failure_outcome(e, stage)
+        reason = "%s: %s" % (type(e).__name__, e)
+        metrics.count('errors', stage='process', exception=type(e).__name__)
+        logger.exception("Error for %r", webgazette)
+        if worker_state['pdb_on_error']:
+            ype, value, tb = sys.exc_info()
+            pdb.post_mortem(tb)
+
+    elapsed = time.time() - start
+    metrics.observe('process_gazette', elapsed)
+    return ProcessedGazette(webgazette,
+                            archived_gazette,
+                            outcome,
+                            reason,
+                            inspection_cached,
+                            worker_state['inspection_cache'].pop_used(),
+                            fetched,
+                            os.getpid(),
+                            elapsed,
+                            metrics.snapshot())
+
+
+def failure_outcome(e, stage):
+    """
+    The ledger outcome for an exception raised while processing a gazette.
+    Metadata can't be derived again from the same inputs with the same
+    rules, but fetching and inspecting the PDF could work next time.
+    """
+    if isinstance(e, NeedsOCRError):
+        return 'needs_ocr'
+    if isinstance(e, UnknownReferrerError):
+        return 'unknown_referrer'
+    if stage == 'metadata':
+        return 'metadata_error'
+    return 'error'
+
+
+def inspect_gazette(cached_gazette_path, store_path):
+    """
+    Returns the Inspection of a PDF from the inspection cache, running
+    pdftotext and pdfinfo only if it isn't cached yet, and whether it was
+    cached.
+    """
+    inspection_cache = worker_state['inspection_cache']
+    metrics = worker_state['metrics']
+    with metrics.timer('content_hash'):
+        pdf_hash = content_hash(cached_gazette_path)
+    with metrics.timer('inspection_cache'):
+        inspection_cache.put_store_path(store_path, pdf_hash)
+        inspection = inspection_cache.get(pdf_hash)
+    if inspection is not None:
+        return inspection, True
+
+    with metrics.timer('pdftotext'):
+        cover_page_text = get_cover_page_text(cached_gazette_path)
+    if is_gazette_index(cover_page_text):
+        inspection = Inspection(cover_page_text, None, True)
     else:
-        raise Exception
+        with metrics.timer('page_count'):
+            pagecount = get_page_count(cached_gazette_path)
+        inspection = Inspection(cover_page_text, pagecount, False)
+    inspection_cache.put(pdf_hash, inspection)
+    return inspection, False
+
+
+def get_archived_gazette(webgazette, inspection):
+    metadata = derive_metadata(webgazette.referrer, webgazette.label)
+    try:
+        volume_number = get_volume_number(webgazette.referrer,
+                                          inspection.cover_page_text)
+    except NeedsOCRError:
+        volume_number = worker_state['volume_index'].get(
+            metadata['publication_title'],
+            metadata['jurisdiction_code'],
+            webgazette.published_date)
+        if volume_number is None:
+            raise
+        logger.info("Volume number of %r inferred from its publication "
+                    "date: %d", webgazette, volume_number)
+    unique_id = get_unique_id(metadata['publication_title'],
+                              metadata['publication_subtitle'],
+                              metadata['jurisdiction_code'],
+                              volume_number,
+                              metadata['issue_number'],
+                              metadata['part_number'],
+                              metadata['language_edition'])
+    archive_path = get_archive_path(unique_id,
+                                    metadata['jurisdiction_code'],
+                                    metadata['special_issue'],
+                                    webgazette.published_date)
+    return {
+        'original_uri': webgazette.original_uri,
+        'archive_path': archive_path,
+        'publication_title': metadata['publication_title'],
+        'publication_subtitle': metadata['publication_subtitle'],
+        'special_issue': metadata['special_issue'],
+        'language_edition': metadata['language_edition'],
+        'issue_number': metadata['issue_number'],
+        'volume_number': volume_number,
+        'jurisdiction_code': metadata['jurisdiction_code'],
+        'publication_date': webgazette.published_date,
+        'unique_id': unique_id,
+        'pagecount': inspection.pagecount,
+        'part': metadata['part_number'],
+    }
+
+
+def touch_inspections(inspection_cache_path, content_hashes):
+    inspection_cache = InspectionCache(inspection_cache_path,
+                                       INSPECTION_CACHE_MAX_ENTRIES)
+    inspection_cache.touch(content_hashes)
+    inspection_cache.close()
+
+
+def evict_inspections(inspection_cache_path, inspection_stats):
+    inspection_cache = InspectionCache(inspection_cache_path,
+                                       INSPECTION_CACHE_MAX_ENTRIES)
+    evicted = inspection_cache.evict()
+    inspection_cache.close()
+    logger.info("Inspection cache: %d hits, %d misses, %d evicted",
+                inspection_stats[True], inspection_stats[False], evicted)
+
+
+def log_throughput(throughput, elapsed):
+    total = sum(count for count, busy in throughput.values())
+    logger.info("Processed %d gazettes in %.1fs (%.2f/s)",
+                total, elapsed, total / elapsed if elapsed else 0)
+    for worker, (count, busy) in sorted(throughput.items()):
+        logger.info("Worker %s: %d gazettes in %.1fs busy (%.2f/s)",
+                    worker, count, busy, count / busy if busy else 0)
+
+
+def get_cover_page_text(cached_gazette_path):
+    """
+    Text of the first page, read from pdftotext's stdout so that nothing
+    but PDFs end up in the cache directory. pdftotext is killed if it takes
+    longer than PDFTOTEXT_TIMEOUT seconds, and only the first
+    COVER_PAGE_TEXT_MAX_BYTES of its output are kept.
+    """
+    process = subprocess.Popen(['pdftotext', '-f', '1', '-l', '1',
+                                cached_gazette_path, '-'],
+                               stdout=subprocess.PIPE)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        process.kill()
+
+    timer = threading.Timer(PDFTOTEXT_TIMEOUT, kill)
+    timer.start()
+    try:
+        text = process.stdout.read(COVER_PAGE_TEXT_MAX_BYTES)
+        truncated = bool(process.stdout.read(1))
+        if truncated:
+            logger.warning("Truncated cover page text of %s at %d bytes",
+                           cached_gazette_path, COVER_PAGE_TEXT_MAX_BYTES)
+            process.kill()
+        process.stdout.close()
+        result = process.wait()
+    finally:
+        timer.cancel()
+
+    if timed_out:
+        raise Exception("pdftotext timed out after %ds" % PDFTOTEXT_TIMEOUT)
+    elif result != 0 and not truncated:
+        raise Exception("pdf_to_text exit status %r" % result)
+    return text
+
+
+def get_page_count(cached_gazette_path):
+    try:
+        return pdf.get_info(cached_gazette_path)['pages']
+    except pdf.PDFError, e:
+        logger.debug("Falling back to pdfinfo for %s: %s", cached_gazette_path, e)
+        with worker_state['metrics'].timer('pdfinfo'):
+            return get_pdfinfo_page_count(cached_gazette_path)
+
+
+def get_pdfinfo_page_count(cached_gazette_path):
+    info = subprocess.check_output(['pdfinfo', cached_gazette_path])
+    regex = 'Pages:\s+(\d+)\s'
+    try:
+        return int(re.search(regex, info).group(1))
+    except AttributeError:
+        raise Exception("Can't find page count in %r" % info)
+
+
+def is_gazette_index(cover_page_text):
+    return 'INDEX OF THE' in cover_page_text
 
 
 def get_unique_id(publication_title,
@@ -499,6 +1668,26 @@ def ensure_dirs(path):
         os.makedirs(dirs)
 
 
+def fetch_to_cache(scrapestore_get, store_path, cached_gazette_path):
+    """
+    Download a gazette into the local cache under a temporary name and then
+    move it into place, so that a partly-downloaded file is never mistaken
+    for a cached one. Returns the size of the file.
+    """
+    partial_path = "%s.part-%d-%d" % (cached_gazette_path,
+                                      os.getpid(),
+                                      threading.current_thread().ident)
+    ensure_dirs(cached_gazette_path)
+    try:
+        scrapestore_get(store_path, partial_path)
+        os.rename(partial_path, cached_gazette_path)
+    except:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return os.path.getsize(cached_gazette_path)
+
+
 def get_function(store_uri):
     uri = urlparse(store_uri)
     if uri.scheme == 'file':
@@ -556,18 +1745,102 @@ def put_function(store_uri):
         raise Exception
 
 
+def supports_server_side_copy(from_store_uri, to_store_uri):
+    return urlparse(from_store_uri).scheme == 's3' and \
+        urlparse(to_store_uri).scheme == 's3'
+
+
+def copy_function(from_store_uri, to_store_uri):
+    """
+    Returns a function to copy a file from one store to another without
+    downloading it, if that's possible for the two stores, otherwise None.
+    """
+    if supports_server_side_copy(from_store_uri, to_store_uri):
+        from_uri = urlparse(from_store_uri)
+        to_uri = urlparse(to_store_uri)
+        conn = boto.connect_s3(to_uri.username, to_uri.password)
+        bucket = conn.get_bucket(to_uri.hostname)
+        return lambda from_relative_path, to_relative_path: s3_copy(bucket,
+                                                                    from_uri.hostname,
+                                                                    from_uri.path,
+                                                                    from_relative_path,
+                                                                    to_uri.path,
+                                                                    to_relative_path)
+    else:
+        return None
+
+
+def copy_within_function(store_uri):
+    """
+    Returns a function to copy a file to another path within a store. The
+    old file is left to be deleted with delete_function.
+    """
+    uri = urlparse(store_uri)
+    if uri.scheme == 'file':
+        store_path = uri.path
+        return lambda from_relative_path, to_relative_path: local_copy(store_path,
+                                                                       from_relative_path,
+                                                                       to_relative_path)
+    elif uri.scheme == 's3':
+        conn = boto.connect_s3(uri.username, uri.password)
+        bucket = conn.get_bucket(uri.hostname)
+        return lambda from_relative_path, to_relative_path: s3_copy(bucket,
+                                                                    uri.hostname,
+                                                                    uri.path,
+                                                                    from_relative_path,
+                                                                    uri.path,
+                                                                    to_relative_path)
+    else:
+        raise Exception
+
+
+def delete_function(store_uri):
+    uri = urlparse(store_uri)
+    if uri.scheme == 'file':
+        store_path = uri.path
+        return lambda relative_path: local_delete(store_path, relative_path)
+    elif uri.scheme == 's3':
+        conn = boto.connect_s3(uri.username, uri.password)
+        bucket = conn.get_bucket(uri.hostname)
+        return lambda relative_path: s3_delete(bucket, uri.path, relative_path)
+    else:
+        raise Exception
+
+
+def local_copy(store_path, from_relative_path, to_relative_path):
+    full_to_path = os.path.join(store_path, to_relative_path)
+    ensure_dirs(full_to_path)
+    shutil.copyfile(os.path.join(store_path, from_relative_path), full_to_path)
+
+
+def local_delete(store_path, relative_path):
+    os.remove(os.path.join(store_path, relative_path))
+
+
+def s3_delete(bucket, key_prefix, key_suffix):
+    bucket.delete_key(os.path.join(key_prefix, key_suffix))
+
+
 def local_put(from_filename, store_path, to_relative_path):
     full_to_path = os.path.join(store_path, to_relative_path)
     ensure_dirs(full_to_path)
-    shutils.copyfile(from_filename, full_to_path)
+    shutil.copyfile(from_filename, full_to_path)
 
 
 def s3_put(bucket, from_filename, to_key_prefix, to_key_suffix):
     key = os.path.join(to_key_prefix, to_key_suffix)
     k = Key(bucket)
     k.key = key
-    k.set_contents_from_filename(from_filename)
-    k.make_public()
+    # Setting the ACL with the upload saves a request per file
+    k.set_contents_from_filename(from_filename, policy='public-read')
+
+
+def s3_copy(bucket, from_bucket_name, from_key_prefix, from_key_suffix,
+            to_key_prefix, to_key_suffix):
+    from_key = os.path.join(from_key_prefix, from_key_suffix)
+    to_key = os.path.join(to_key_prefix, to_key_suffix)
+    bucket.copy_key(to_key, from_bucket_name, from_key,
+                    headers={'x-amz-acl': 'public-read'})
 
 
 
@@ -0,0 +1,196 @@
+"""
+Keeps the local cache of scraped PDFs within a byte budget.
+
+The cache directory is a copy of part of the scrape store, so any file in
+it can be fetched again. An index of the files in it, their sizes and when
+they were last used is kept in SQLite next to them, so that the least
+recently used files can be found and the cache's size is known without
+walking the tree on every run.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of least recently used entries considered per eviction query
+EVICTION_BATCH_SIZE = 100
+
+
+class LocalCache(object):
+    """
+    Tracks the files in the local cache and evicts the least recently used
+    ones once they take up more than max_bytes. If max_bytes is None the
+    cache is only tracked, never evicted from.
+
+    Files are pinned while they're being processed or uploaded and pinned
+    files are never evicted, even if that leaves the cache over budget
+    for a while.
+
+    The index is built by walking the cache directory the first time it is
+    opened. After that it's only told about files as they're used, so it
+    should only be opened from the process which schedules the work.
+    """
+
+    def __init__(self, cache_path, max_bytes, index_path=None):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.index_path = index_path or os.path.join(cache_path,
+                                                     'cache-index.sqlite')
+        self.pinned = {}
+        self.indexed_when_pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.conn = sqlite3.connect(self.index_path, timeout=60)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cached_file (
+                store_path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS cached_file_last_used
+            ON cached_file (last_used)""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_index_info (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )""")
+        self.conn.commit()
+        if self.conn.execute("""
+            SELECT 1 FROM cache_index_info WHERE key = 'built'""").fetchone() is None:
+            self.build()
+        self.total_bytes = self.conn.execute("""
+            SELECT COALESCE(SUM(size), 0) FROM cached_file""").fetchone()[0]
+
+    def build(self):
+        """
+        Index the files already in the cache directory. Their modification
+        time stands in for when they were last used. Scrape store paths are
+        always in a subdirectory, so files at the top level, like this index
+        and the inspection cache, aren't cached PDFs.
+        """
+        logger.info("Building the local cache index in %s", self.index_path)
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_path):
+            if os.path.samefile(dirpath, self.cache_path):
+                continue
+            for filename in filenames:
+                if '.part-' in filename:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                store_path = os.path.relpath(path, self.cache_path)
+                self.conn.execute("""
+                    INSERT OR REPLACE INTO cached_file (store_path, size, last_used)
+                    VALUES (?, ?, ?)""", (store_path, stat.st_size, stat.st_mtime))
+                count += 1
+        self.conn.execute("""
+            INSERT OR REPLACE INTO cache_index_info (key, value)
+            VALUES ('built', ?)""", (repr(time.time()),))
+        self.conn.commit()
+        logger.info("Indexed %d files in the local cache", count)
+
+    def pin(self, store_path):
+        if store_path not in self.pinned:
+            self.pinned[store_path] = 0
+            self.indexed_when_pinned[store_path] = self.conn.execute("""
+                SELECT 1 FROM cached_file WHERE store_path = ?""",
+                (store_path,)).fetchone() is not None
+        self.pinned[store_path] += 1
+
+    def pin_all(self, webgazettes):
+        """
+        Pin each gazette's file as it is taken from webgazettes, before it
+        is downloaded.
+        """
+        for webgazette in webgazettes:
+            self.pin(webgazette.store_path)
+            yield webgazette
+
+    def unpin(self, store_path):
+        self.pinned[store_path] -= 1
+        if not self.pinned[store_path]:
+            del self.pinned[store_path]
+            del self.indexed_when_pinned[store_path]
+
+    def used(self, store_path, fetched):
+        """
+        Record that a pinned file has been used. fetched is whether it had
+        to be downloaded to be used. It only counts as a hit if it was in the
+        cache before it was pinned, since a file that's pinned is only
+        prefetched because it's about to be used.
+        """
+        path = os.path.join(self.cache_path, store_path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if not fetched and self.indexed_when_pinned.get(store_path):
+            self.hits += 1
+        else:
+            self.misses += 1
+        row = self.conn.execute("""
+            SELECT size FROM cached_file WHERE store_path = ?""",
+                                (store_path,)).fetchone()
+        self.total_bytes += size - (row[0] if row else 0)
+        self.conn.execute("""
+            INSERT OR REPLACE INTO cached_file (store_path, size, last_used)
+            VALUES (?, ?, ?)""", (store_path, size, time.time()))
+
+    def over_budget(self):
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    def evict(self):
+        """
+        Delete the least recently used files which aren't pinned until the
+        cache is within its budget.
+        """
+        offset = 0
+        while self.over_budget():
+            rows = self.conn.execute("""
+                SELECT store_path, size FROM cached_file
+                ORDER BY last_used LIMIT ? OFFSET ?""",
+                                     (EVICTION_BATCH_SIZE, offset)).fetchall()
+            if not rows:
+                logger.warning("Local cache is %d bytes over budget but "
+                               "everything left is in use",
+                               self.total_bytes - self.max_bytes)
+                break
+            for store_path, size in rows:
+                if not self.over_budget():
+                    break
+                if store_path in self.pinned:
+                    offset += 1
+                    continue
+                try:
+                    os.remove(os.path.join(self.cache_path, store_path))
+                except OSError, e:
+                    # Already gone - it no longer takes up space either way
+                    logger.debug("Error evicting %s: %s", store_path, e)
+                self.conn.execute("""
+                    DELETE FROM cached_file WHERE store_path = ?""",
+                                  (store_path,))
+                self.total_bytes -= size
+                self.evicted_files += 1
+                self.evicted_bytes += size
+        self.conn.commit()
+
+    def log_stats(self):
+        used = self.hits + self.misses
+        logger.info("Local cache: %d hits, %d misses (%.1f%% hit ratio), "
+                    "%d files (%d bytes) evicted, %d bytes cached",
+                    self.hits, self.misses,
+                    100.0 * self.hits / used if used else 0,
+                    self.evicted_files, self.evicted_bytes, self.total_bytes)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,142 @@
+"""
+Shares an archive run between archivers on different hosts using the same
+Postgres database.
+
+Gazettes are handed out in blocks of consecutive web_scraped_gazette ids.
+Each archiver claims the next unclaimed block with SELECT ... FOR UPDATE
+SKIP LOCKED, so archivers never wait for each other to claim work. Claims
+are leases, so blocks claimed by an archiver which died are claimed again
+once their lease runs out.
+"""
+
+from collections import deque
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+SEED_ATTEMPTS = 3
+
+SEED_SQL = text("""
+    INSERT INTO archive_claim (run, block, done)
+    SELECT :run, blocks.block, false
+    FROM (SELECT DISTINCT id / :block_size AS block
+          FROM web_scraped_gazette) AS blocks
+    WHERE NOT EXISTS (SELECT 1 FROM archive_claim
+                      WHERE run = :run AND block = blocks.block)""")
+
+CLAIM_SQL = text("""
+    UPDATE archive_claim
+    SET claimed_by = :node,
+        lease_expires_at = now() + :lease_seconds * interval '1 second'
+    WHERE run = :run AND block = (
+        SELECT block FROM archive_claim
+        WHERE run = :run
+          AND NOT done
+          AND (lease_expires_at IS NULL OR lease_expires_at < now())
+        ORDER BY block
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING block""")
+
+RENEW_SQL = text("""
+    UPDATE archive_claim
+    SET lease_expires_at = now() + :lease_seconds * interval '1 second'
+    WHERE run = :run AND claimed_by = :node AND NOT done""")
+
+DONE_SQL = text("""
+    UPDATE archive_claim SET done = true
+    WHERE run = :run AND block = :block AND claimed_by = :node""")
+
+
+def node_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Claims(object):
+    """
+    The blocks of a run this archiver has claimed, in the order it claimed
+    them. Blocks are processed in that order, so a block is finished once
+    a gazette from a later block has been archived.
+    """
+
+    def __init__(self, engine, run, block_size, lease_seconds, node=None):
+        if engine.dialect.name != 'postgresql':
+            raise Exception("Claiming work needs Postgres, not %s"
+                            % engine.dialect.name)
+        self.engine = engine
+        self.run = run
+        self.block_size = block_size
+        self.lease_seconds = lease_seconds
+        self.node = node or node_name()
+        self.held = deque()
+
+    def seed(self):
+        """
+        Add a claim for every block of gazettes which the run doesn't have
+        one for yet. Several archivers may start at the same time, so this
+        is retried if another one is adding the same claims.
+        """
+        for attempt in range(SEED_ATTEMPTS):
+            try:
+                with self.engine.begin() as conn:
+                    count = conn.execute(SEED_SQL, run=self.run,
+                                         block_size=self.block_size).rowcount
+                logger.info("Added %d blocks of %d gazettes to run %r",
+                            count, self.block_size, self.run)
+                return
+            except IntegrityError, e:
+                logger.debug("Another archiver is seeding run %r: %s",
+                             self.run, e)
+        raise Exception("Couldn't add claims for run %r" % self.run)
+
+    def claim(self):
+        """
+        Claim the next available block. Returns the range of ids in it, or
+        None if every block is done or claimed by a live archiver.
+        """
+        with self.engine.begin() as conn:
+            row = conn.execute(CLAIM_SQL, run=self.run, node=self.node,
+                               lease_seconds=self.lease_seconds).fetchone()
+        if row is None:
+            return None
+        block = row[0]
+        self.held.append(block)
+        logger.info("%s claimed block %d of run %r", self.node, block, self.run)
+        return (block * self.block_size, (block + 1) * self.block_size)
+
+    def __iter__(self):
+        while True:
+            id_range = self.claim()
+            if id_range is None:
+                return
+            yield id_range
+
+    def renew(self):
+        with self.engine.begin() as conn:
+            conn.execute(RENEW_SQL, run=self.run, node=self.node,
+                         lease_seconds=self.lease_seconds)
+
+    def archived_through(self, last_id):
+        """
+        Mark the blocks before the one last_id is in as done, and renew the
+        leases of the rest.
+        """
+        block = last_id // self.block_size
+        while self.held and self.held[0] != block:
+            self.done(self.held.popleft())
+        self.renew()
+
+    def finish(self):
+        while self.held:
+            self.done(self.held.popleft())
+
+    def done(self, block):
+        with self.engine.begin() as conn:
+            if not conn.execute(DONE_SQL, run=self.run, block=block,
+                                node=self.node).rowcount:
+                logger.warning("Block %d of run %r was claimed by another "
+                               "archiver before it was done", block, self.run)
@@ -0,0 +1,159 @@
+"""
+A persistent cache of what the archiver found out by running pdftotext and
+pdfinfo on a gazette PDF. It is keyed by the hash of the PDF's contents so
+that re-runs, or runs after metadata rules changed, don't need to spawn
+those again for a file that has been inspected before.
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# What we know about a PDF's contents. pagecount is None for indexes because
+# they aren't archived so their page count isn't needed.
+Inspection = namedtuple('Inspection', [
+    'cover_page_text',
+    'pagecount',
+    'is_index',
+])
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class InspectionCache(object):
+    """
+    SQLite-backed Inspection cache. Each process should open its own
+    InspectionCache - SQLite serialises writes between them.
+
+    Entries remember when they were last used, and evict() drops the least
+    recently used ones beyond max_entries. Hits don't write to the database,
+    since every worker process reads from it at once - the content hashes
+    that were hit are kept in used, for the main process to touch() in one
+    go.
+
+    It also remembers which content hash the file at each scrape store path
+    had, so that an Inspection can be found without fetching the file.
+    Files in the scrape store are named after the URL they were scraped
+    from and aren't expected to change.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS inspection (
+                content_hash TEXT PRIMARY KEY,
+                cover_page_text BLOB NOT NULL,
+                pagecount INTEGER,
+                is_index INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS inspection_last_used
+            ON inspection (last_used)""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS store_path (
+                store_path TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL
+            )""")
+        self.conn.commit()
+
+    def get(self, content_hash):
+        row = self.conn.execute("""
+            SELECT cover_page_text, pagecount, is_index
+            FROM inspection WHERE content_hash = ?""",
+                                (content_hash,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add(content_hash)
+        cover_page_text, pagecount, is_index = row
+        return Inspection(str(cover_page_text), pagecount, bool(is_index))
+
+    def get_by_store_path(self, store_path):
+        row = self.conn.execute("""
+            SELECT content_hash FROM store_path WHERE store_path = ?""",
+                                (store_path,)).fetchone()
+        if row is None:
+            return None
+        return self.get(row[0])
+
+    def has_store_path(self, store_path):
+        return self.conn.execute("""
+            SELECT 1 FROM store_path JOIN inspection USING (content_hash)
+            WHERE store_path = ?""", (store_path,)).fetchone() is not None
+
+    def put_store_path(self, store_path, content_hash):
+        row = self.conn.execute("""
+            SELECT content_hash FROM store_path WHERE store_path = ?""",
+                                (store_path,)).fetchone()
+        if row is not None and row[0] == content_hash:
+            return
+        self.conn.execute("""
+            INSERT OR REPLACE INTO store_path (store_path, content_hash)
+            VALUES (?, ?)""", (store_path, content_hash))
+        self.conn.commit()
+
+    def put(self, content_hash, inspection):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO inspection
+            (content_hash, cover_page_text, pagecount, is_index, last_used)
+            VALUES (?, ?, ?, ?, ?)""",
+                          (content_hash,
+                           sqlite3.Binary(inspection.cover_page_text),
+                           inspection.pagecount,
+                           inspection.is_index,
+                           time.time()))
+        self.conn.commit()
+
+    def pop_used(self):
+        """The content hashes hit since the last call"""
+        used = self.used
+        self.used = set()
+        return used
+
+    def touch(self, content_hashes):
+        """Mark entries as used now, in one transaction"""
+        now = time.time()
+        self.conn.executemany("""
+            UPDATE inspection SET last_used = ? WHERE content_hash = ?""",
+                              ((now, content_hash) for content_hash in content_hashes))
+        self.conn.commit()
+
+    def evict(self):
+        """
+        Drop the least recently used entries beyond max_entries.
+        Returns the number of entries evicted.
+        """
+        cursor = self.conn.execute("""
+            DELETE FROM inspection WHERE content_hash IN (
+                SELECT content_hash FROM inspection
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET ?
+            )""", (self.max_entries,))
+        self.conn.execute("""
+            DELETE FROM store_path WHERE content_hash NOT IN (
+                SELECT content_hash FROM inspection
+            )""")
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,187 @@
+"""
+A record of the scraped gazettes which weren't archived and why, so that
+later runs don't download and inspect them again for nothing.
+
+Outcomes which only depend on a gazette's scraped data and the metadata
+rules, like indexes and unknown listing pages, are skipped until the
+gazette's label, referrer, date or file changes, or RULE_VERSION is bumped.
+Other failures, like downloads which failed, are retried with exponential
+backoff. So are gazettes which need OCR, because their volume number can
+be inferred once gazettes published around the same date are archived.
+"""
+
+from datetime import datetime, timedelta, tzinfo
+from gazettes.metadata import RULE_VERSION
+from gazettes.models import ArchiveLedger
+from sqlalchemy import bindparam, select
+import calendar
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Outcomes which will be the same every time until the inputs or the rules
+# change
+PERMANENT_OUTCOMES = frozenset([
+    'index',
+    'unknown_referrer',
+    'metadata_error',
+])
+RETRY_BASE_SECONDS = 60 * 60
+RETRY_MAX_SECONDS = 7 * 24 * 60 * 60
+
+
+class UTC(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return timedelta(0)
+
+utc = UTC()
+
+
+def input_hash(webgazette):
+    """A hash of the scraped data that a gazette's outcome depends on"""
+    sha1 = hashlib.sha1()
+    for value in (webgazette.referrer, webgazette.label,
+                  webgazette.published_date.isoformat(), webgazette.store_path):
+        sha1.update(value.encode('utf-8') if isinstance(value, unicode) else value)
+        sha1.update('\0')
+    return sha1.hexdigest()
+
+
+def to_timestamp(dt):
+    # Naive datetimes are stored as UTC
+    return calendar.timegm(dt.utctimetuple())
+
+
+class Ledger(object):
+    """
+    The ledger entries by web_scraped_gazette id. Changes are kept in
+    memory and written by flush().
+    """
+
+    def __init__(self, entries):
+        # id -> (outcome, input_hash, rule_version, attempts, next_attempt_at)
+        self.entries = entries
+        self.changed = {}
+        self.resolved = set()
+        self.skipped = 0
+
+    @classmethod
+    def load(cls, session):
+        return cls(dict((row[0], tuple(row[1:])) for row in session.query(
+            ArchiveLedger.web_scraped_gazette_id,
+            ArchiveLedger.outcome,
+            ArchiveLedger.input_hash,
+            ArchiveLedger.rule_version,
+            ArchiveLedger.attempts,
+            ArchiveLedger.next_attempt_at)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def should_skip(self, webgazette, now=None):
+        entry = self.entries.get(webgazette.id)
+        if entry is None:
+            return False
+        outcome, entry_hash, rule_version, attempts, next_attempt_at = entry
+        if outcome in PERMANENT_OUTCOMES:
+            skip = entry_hash == input_hash(webgazette) and \
+                   rule_version == RULE_VERSION
+        else:
+            now = now or datetime.now(utc)
+            skip = next_attempt_at is not None and \
+                   to_timestamp(next_attempt_at) > to_timestamp(now)
+        if skip:
+            logger.debug("Skipping %r: %s in the ledger", webgazette, outcome)
+            self.skipped += 1
+        return skip
+
+    def record(self, webgazette, outcome, reason, now=None):
+        now = now or datetime.now(utc)
+        previous = self.entries.get(webgazette.id)
+        if previous is not None and previous[0] == outcome:
+            attempts = previous[3] + 1
+        else:
+            attempts = 1
+        if outcome in PERMANENT_OUTCOMES:
+            next_attempt_at = None
+        else:
+            delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+                        RETRY_MAX_SECONDS)
+            next_attempt_at = now + timedelta(seconds=delay)
+        entry = (outcome, input_hash(webgazette), RULE_VERSION, attempts,
+                 next_attempt_at)
+        self.entries[webgazette.id] = entry
+        self.changed[webgazette.id] = entry + (reason,)
+        self.resolved.discard(webgazette.id)
+
+    def resolve(self, webgazette):
+        """Forget a gazette that has been archived"""
+        if webgazette.id in self.entries:
+            del self.entries[webgazette.id]
+            self.changed.pop(webgazette.id, None)
+            self.resolved.add(webgazette.id)
+
+    def flush(self, Session):
+        """
+        Write the changes since the last flush. Gazettes already in the
+        ledger have their rows updated, so created_at is when a gazette
+        first wasn't archived.
+        """
+        if not self.changed and not self.resolved:
+            return
+        table = ArchiveLedger.__table__
+        ids = list(self.resolved) + list(self.changed)
+        session = Session()
+        try:
+            if self.resolved:
+                session.execute(table.delete().where(
+                    table.c.web_scraped_gazette_id.in_(self.resolved)))
+            if self.changed:
+                stored = set(row[0] for row in session.execute(
+                    select([table.c.web_scraped_gazette_id]).where(
+                        table.c.web_scraped_gazette_id.in_(self.changed.keys()))))
+                now = datetime.now(utc)
+                updates = []
+                inserts = []
+                for gazette_id, (outcome, entry_hash, rule_version, attempts,
+                                 next_attempt_at, reason) \
+                        in self.changed.iteritems():
+                    row = {
+                        'outcome': outcome,
+                        'input_hash': entry_hash,
+                        'rule_version': rule_version,
+                        'attempts': attempts,
+                        'next_attempt_at': next_attempt_at,
+                        'reason': reason,
+                        'updated_at': now,
+                    }
+                    if gazette_id in stored:
+                        row['gazette_id'] = gazette_id
+                        updates.append(row)
+                    else:
+                        row['web_scraped_gazette_id'] = gazette_id
+                        inserts.append(row)
+                if updates:
+                    session.execute(table.update().where(
+                        table.c.web_scraped_gazette_id
+                        == bindparam('gazette_id')), updates)
+                if inserts:
+                    session.execute(table.insert(), inserts)
+            session.commit()
+        except Exception, e:
+            # Another archiver sharing the run may have written the same
+            # entries. They'll be tried again next run either way.
+            session.rollback()
+            logger.warning("Error updating the ledger for %d gazettes: %s",
+                           len(ids), e)
+        finally:
+            session.close()
+        self.changed = {}
+        self.resolved = set()
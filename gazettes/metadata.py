@@ -0,0 +1,208 @@
+"""
+Rules for deriving gazette metadata from where a gazette was scraped.
+
+Rules are registered per host in HOSTS, and per listing page path within a
+host where the page determines the publication. Patterns are compiled once
+and the referrer is parsed once per gazette, so all the label-derived
+metadata comes from a single derive_metadata call.
+"""
+
+from collections import namedtuple
+from urlparse import urlparse
+import re
+
+
+# Bump this when the rules change in a way that could change the outcome for
+# gazettes which failed before, so that they're tried again.
+RULE_VERSION = 2
+
+
+class NeedsOCRError(Exception):
+    pass
+
+
+class UnknownReferrerError(Exception):
+    """The referrer's host or path doesn't have rules yet"""
+
+
+# Rules for everything scraped from a host. The patterns are matched against
+# the label, except volume_number which is matched against the cover page
+# text. A pattern of None means the host's gazettes don't have that field.
+# sources maps listing page paths to Sources, or is None if all the host's
+# gazettes come from default_source.
+Host = namedtuple('Host', [
+    'issue_number',
+    'part_number',
+    'language_edition',
+    'volume_number',
+    'sources',
+    'default_source',
+])
+
+# The publication a listing page lists gazettes of. fields are the same for
+# every gazette on the page. from_label, if given, returns the fields which
+# depend on the gazette's label.
+Source = namedtuple('Source', ['fields', 'from_label'])
+
+
+def source(publication_title=None, jurisdiction_code=None,
+           publication_subtitle=None, special_issue=None, from_label=None):
+    return Source({
+        'publication_title': publication_title,
+        'publication_subtitle': publication_subtitle,
+        'special_issue': special_issue,
+        'jurisdiction_code': jurisdiction_code,
+    }, from_label)
+
+
+LEGAL_GAZETTE_RE = re.compile(r'Legal? ?([A-C])')
+
+
+def legal_gazette(label):
+    match = LEGAL_GAZETTE_RE.search(label)
+    if not match:
+        raise Exception("Can't find legal gazette letter in '%s'" % label)
+    return {'publication_subtitle': "Legal Gazette %s" % match.group(1)}
+
+
+# Liquor license gazettes are listed together, so the label tells us whose
+# they are. The first match wins.
+LIQUOR_LICENSE_JURISDICTIONS = [
+    (re.compile(r'NCape|NKaap|Northern Cape'), 'Provincial Gazette', 'ZA-NC'),
+    (re.compile(r'gaut', re.IGNORECASE), 'Provincial Gazette', 'ZA-GT'),
+    (re.compile(r'National'), 'Government Gazette', 'ZA'),
+]
+
+
+def liquor_licenses(label):
+    for pattern, publication_title, jurisdiction_code in LIQUOR_LICENSE_JURISDICTIONS:
+        if pattern.search(label):
+            return {
+                'publication_title': publication_title,
+                'jurisdiction_code': jurisdiction_code,
+            }
+    raise Exception("unknown jurisdiction for '%s'" % label)
+
+
+def provincial_gazette(jurisdiction_code):
+    return source('Provincial Gazette', jurisdiction_code)
+
+
+HOSTS = {
+    'www.gpwonline.co.za': Host(
+        issue_number=re.compile(r'^(\d+)[_ ]\w'),
+        part_number=re.compile(r'(?:Part|P) ?(\d+)$'),
+        language_edition=None,
+        volume_number=re.compile(r'Vol.\x00? ?(\d+)'),
+        sources={
+            '/Gazettes/Pages/Provincial-Gazettes-Eastern-Cape.aspx':
+            provincial_gazette('ZA-EC'),
+            '/Gazettes/Pages/Provincial-Gazettes-Gauteng.aspx':
+            provincial_gazette('ZA-GT'),
+            '/Gazettes/Pages/Provincial-Gazettes-KwaZulu-Natal.aspx':
+            provincial_gazette('ZA-NL'),
+            '/Gazettes/Pages/Provincial-Gazettes-Limpopo.aspx':
+            provincial_gazette('ZA-LP'),
+            '/Gazettes/Pages/Provincial-Gazettes-Mpumalanga.aspx':
+            provincial_gazette('ZA-MP'),
+            '/Gazettes/Pages/Provincial-Gazettes-North-West.aspx':
+            provincial_gazette('ZA-NW'),
+            '/Gazettes/Pages/Provincial-Gazettes-Northern-Cape.aspx':
+            provincial_gazette('ZA-NC'),
+            '/Gazettes/Pages/Published-Legal-Gazettes.aspx':
+            source('Government Gazette', 'ZA', from_label=legal_gazette),
+            '/Gazettes/Pages/Published-National-Government-Gazettes.aspx':
+            source('Government Gazette', 'ZA'),
+            '/Gazettes/Pages/Published-National-Regulation-Gazettes.aspx':
+            source('Government Gazette', 'ZA',
+                   publication_subtitle='Regulation Gazette'),
+            '/Gazettes/Pages/Published-Separate-Gazettes.aspx':
+            source('Government Gazette', 'ZA'),
+            '/Gazettes/Pages/Road-Access-Permits.aspx':
+            source('Government Gazette', 'ZA',
+                   special_issue='Road Carrier Permits'),
+            '/Gazettes/Pages/Published-Liquor-Licenses.aspx':
+            source(special_issue='Liquor Licenses', from_label=liquor_licenses),
+            '/Gazettes/Pages/Published-Tender-Bulletin.aspx':
+            source('Tender Bulletin', 'ZA'),
+        },
+        default_source=None,
+    ),
+    'www.westerncape.gov.za': Host(
+        issue_number=re.compile(r'^[a-zA-Z ]+(\d+)[ae]? ?(?:Extraordinary )?-'),
+        part_number=None,
+        # 'Provincial Gazette Extraordinary 6445a - 18 June 2007'
+        # 'Provincial Gazette Extraordinary 6445e - 18 June 2007'
+        language_edition=re.compile(r'^[a-zA-Z ]+\d+([ae]) -'),
+        volume_number=None,
+        sources=None,
+        default_source=provincial_gazette('ZA-WC'),
+    ),
+}
+
+LANGUAGE_EDITIONS = {
+    'a': 'AF',
+    'e': 'EN',
+}
+
+# (Host, Source) by referrer. There are only as many referrers as listing
+# pages, so this stays small.
+rules_cache = {}
+
+
+def get_rules(referrer):
+    rules = rules_cache.get(referrer)
+    if rules is None:
+        url = urlparse(referrer)
+        host = HOSTS.get(url.hostname)
+        if host is None:
+            raise UnknownReferrerError("unknown host '%s'" % url.hostname)
+        if host.sources is None:
+            rules = (host, host.default_source)
+        elif url.path in host.sources:
+            rules = (host, host.sources[url.path])
+        else:
+            raise UnknownReferrerError("unknown path '%s'" % url.path)
+        rules_cache[referrer] = rules
+    return rules
+
+
+def derive_metadata(referrer, label):
+    """
+    Returns a dict of the metadata which can be derived from the referrer
+    and label of a gazette: publication_title, publication_subtitle,
+    special_issue, jurisdiction_code, issue_number, part_number and
+    language_edition.
+    """
+    host, source = get_rules(referrer)
+    metadata = dict(source.fields)
+    if source.from_label:
+        metadata.update(source.from_label(label))
+
+    match = host.issue_number.search(label)
+    if not match:
+        raise Exception("Can't find issue number in '%s'" % label)
+    metadata['issue_number'] = int(match.group(1))
+
+    match = host.part_number and host.part_number.search(label)
+    metadata['part_number'] = int(match.group(1)) if match else None
+
+    match = host.language_edition and host.language_edition.search(label)
+    metadata['language_edition'] = LANGUAGE_EDITIONS[match.group(1)] if match else None
+
+    return metadata
+
+
+def has_volume_number(referrer):
+    host, source = get_rules(referrer)
+    return host.volume_number is not None
+
+
+def get_volume_number(referrer, cover_page_text):
+    host, source = get_rules(referrer)
+    if host.volume_number is None:
+        return None
+    match = host.volume_number.search(cover_page_text)
+    if not match:
+        raise NeedsOCRError("Can't find volume number in %r" % cover_page_text)
+    return int(match.group(1))
@@ -0,0 +1,183 @@
+"""
+Timings and counts of what the archiver spends its time on.
+
+Stage timings are kept as histograms with fixed buckets, so that metrics
+collected in worker processes can be merged into the main process's by
+adding them up. Summaries are written as JSON and in the Prometheus text
+exposition format, e.g. for node_exporter's textfile collector.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+PROMETHEUS_PREFIX = 'gazettes_archive'
+
+
+class Metrics(object):
+    """
+    Stage timing histograms and counters. Counters can have labels, e.g.
+    count('errors', exception='NeedsOCRError'). Safe to use from several
+    threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> [count per bucket, total count, total seconds]
+        self.stages = {}
+        # (name, sorted label items) -> value
+        self.counters = defaultdict(int)
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = [[0] * len(BUCKETS), 0, 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def snapshot(self):
+        """
+        A picklable copy of the metrics, for sending from workers to be
+        merged.
+        """
+        with self.lock:
+            return ({stage: [list(buckets), count, seconds]
+                     for stage, (buckets, count, seconds)
+                     in self.stages.iteritems()},
+                    dict(self.counters))
+
+    def merge(self, snapshot):
+        stages, counters = snapshot
+        with self.lock:
+            for stage, (buckets, count, seconds) in stages.iteritems():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = [[0] * len(BUCKETS), 0, 0.0]
+                for i, bucket_count in enumerate(buckets):
+                    histogram[0][i] += bucket_count
+                histogram[1] += count
+                histogram[2] += seconds
+            for key, value in counters.iteritems():
+                self.counters[key] += value
+
+    def summary(self):
+        """
+        The metrics as a dict for JSON. Stage percentiles are estimated
+        from the buckets they fall in.
+        """
+        with self.lock:
+            elapsed = time.time() - self.started
+            stages = {}
+            for stage, (buckets, count, seconds) in self.stages.iteritems():
+                stages[stage] = {
+                    'count': count,
+                    'seconds': seconds,
+                    'mean_seconds': seconds / count if count else None,
+                    'p50_seconds': percentile(buckets, count, 0.5),
+                    'p95_seconds': percentile(buckets, count, 0.95),
+                    'p99_seconds': percentile(buckets, count, 0.99),
+                    'buckets': [[format_bound(bound), bucket_count]
+                                for bound, bucket_count
+                                in zip(BUCKETS, buckets)],
+                }
+            counters = defaultdict(dict)
+            for (name, labels), value in sorted(self.counters.iteritems()):
+                label = ','.join('%s=%s' % item for item in labels)
+                if label:
+                    counters[name][label] = value
+                else:
+                    counters[name] = value
+            return {
+                'elapsed_seconds': elapsed,
+                'stages': stages,
+                'counters': dict(counters),
+            }
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            name = '%s_stage_seconds' % PROMETHEUS_PREFIX
+            lines.append('# HELP %s Time spent in each stage of archival' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for stage, (buckets, count, seconds) in sorted(self.stages.iteritems()):
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, buckets):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d'
+                                 % (name, stage, format_bound(bound), cumulative))
+                lines.append('%s_sum{stage="%s"} %f' % (name, stage, seconds))
+                lines.append('%s_count{stage="%s"} %d' % (name, stage, count))
+
+            names = sorted(set(name for name, labels in self.counters))
+            for counter in names:
+                name = '%s_%s_total' % (PROMETHEUS_PREFIX, counter)
+                lines.append('# TYPE %s counter' % name)
+                for (counter_name, labels), value in sorted(self.counters.iteritems()):
+                    if counter_name != counter:
+                        continue
+                    label = ','.join('%s="%s"' % (key, escape_label(label_value))
+                                     for key, label_value in labels)
+                    lines.append('%s%s %d' % (name,
+                                              '{%s}' % label if label else '',
+                                              value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path_prefix):
+        """Write path_prefix.json and path_prefix.prom"""
+        write_atomically(path_prefix + '.json',
+                         json.dumps(self.summary(), indent=2, sort_keys=True))
+        write_atomically(path_prefix + '.prom', self.prometheus())
+
+
+def percentile(buckets, count, fraction):
+    """The upper bound of the bucket the percentile falls in"""
+    if not count:
+        return None
+    rank = fraction * count
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return None if bound == float('inf') else bound
+    return None
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def write_atomically(path, content):
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
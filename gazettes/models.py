@@ -151,6 +151,7 @@ class ArchivedGazette(Base):
             unique_id=dict['unique_id'],
             pagecount=dict['pagecount'],
             language_edition=dict['language_edition'],
+            part=dict.get('part'),
         )
 
     schema = {
@@ -198,3 +199,55 @@ class ArchivedGazette(Base):
             ]},
         },
     }
+
+
+class ArchiveClaim(Base):
+    """
+    A block of web_scraped_gazette ids which an archiver has claimed to
+    archive, so that several archivers can share a run against the same
+    database. Block n is the gazettes with ids from n * block size up to
+    but excluding (n + 1) * block size.
+
+    A claim is only held until its lease expires. An archiver renews the
+    leases of the blocks it's working on as it goes, so that a block
+    claimed by an archiver that died is claimed again by another one.
+    """
+    __tablename__ = 'archive_claim'
+
+    # The name the archivers sharing the work were given for the run
+    run = Column(String, primary_key=True)
+    block = Column(Integer, primary_key=True)
+    # e.g. "archiver-host:1234"
+    claimed_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    done = Column(Boolean, default=False, nullable=False)
+
+
+class ArchiveLedger(Base):
+    """
+    Why a scraped gazette wasn't archived the last time it was processed.
+    Gazettes are removed from the ledger once they're archived.
+    """
+    __tablename__ = 'archive_ledger'
+
+    web_scraped_gazette_id = Column(Integer, primary_key=True)
+    # e.g. "index", "needs_ocr", "unknown_referrer", "metadata_error", "error"
+    outcome = Column(String, nullable=False)
+    # e.g. the exception message
+    reason = Column(String, nullable=True)
+    # Hash of the scraped data the outcome was decided from
+    input_hash = Column(String, nullable=False)
+    # gazettes.metadata.RULE_VERSION when the outcome was decided
+    rule_version = Column(Integer, nullable=False)
+    # Number of times in a row the gazette had this outcome
+    attempts = Column(Integer, nullable=False)
+    # When a failure which might not happen again should be retried. Null
+    # for outcomes which only change if the inputs or rules change.
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True),
+                        nullable=False,
+                        server_default=func.now())
+    updated_at = Column(DateTime(timezone=True),
+                        nullable=False,
+                        server_default=func.now(),
+                        onupdate=func.current_timestamp())
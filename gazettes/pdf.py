@@ -0,0 +1,503 @@
+"""
+Just enough of a PDF parser to read the page count and document info of a
+gazette straight from the file, instead of running pdfinfo.
+
+The file is memory-mapped and only the trailer, the cross-reference tables
+or streams, the document catalog, the page tree root and the document info
+dictionary are parsed. It doesn't try to repair damaged files - anything
+unexpected raises PDFError so that callers can fall back to pdfinfo.
+"""
+
+from collections import namedtuple
+import mmap
+import re
+import zlib
+
+
+class PDFError(Exception):
+    pass
+
+
+# An indirect object reference, e.g. "12 0 R"
+Ref = namedtuple('Ref', ['num', 'gen'])
+
+# A stream object: its dictionary and its undecoded data
+Stream = namedtuple('Stream', ['dict', 'raw'])
+
+
+class Name(str):
+    """A PDF name object, e.g. /FlateDecode, without the slash"""
+
+
+# Document info dictionary entries returned by get_info
+INFO_KEYS = (
+    'Title',
+    'Author',
+    'Subject',
+    'Creator',
+    'Producer',
+    'CreationDate',
+    'ModDate',
+)
+
+# How far from the end of the file to look for startxref
+TAIL_SIZE = 2048
+# Longest chain of references we follow before giving up
+MAX_REF_DEPTH = 32
+
+WS = '\x00\t\n\x0c\r '
+REGULAR = r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]'
+WHITESPACE_RE = re.compile(r'(?:[\x00\t\n\x0c\r ]|%[^\r\n]*)*')
+NUMBER_RE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)')
+INTEGER_RE = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)')
+REF_RE = re.compile(r'[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?!%s)' % REGULAR)
+NAME_RE = re.compile(r'/(%s*)' % REGULAR)
+NAME_ESCAPE_RE = re.compile(r'#([0-9A-Fa-f]{2})')
+KEYWORD_RE = re.compile(r'[A-Za-z]+')
+HEX_STRING_RE = re.compile(r'<([0-9A-Fa-f\x00\t\n\x0c\r ]*)>')
+OBJ_RE = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)'
+                    r'[\x00\t\n\x0c\r ]+obj')
+STREAM_RE = re.compile(r'[\x00\t\n\x0c\r ]*stream(?:\r\n|\n|\r)')
+XREF_ENTRY_RE = re.compile(r'(\d{10}) (\d{5}) ([nf])[\r\n ]{2}')
+
+STRING_ESCAPES = {
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'b': '\b',
+    'f': '\f',
+    '(': '(',
+    ')': ')',
+    '\\': '\\',
+}
+
+
+def get_info(path):
+    """
+    Returns a dict with the page count of the PDF at path under 'pages',
+    and any of INFO_KEYS found in its document info dictionary.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError), e:
+            raise PDFError("Can't map %s: %s" % (path, e))
+    try:
+        return Document(data).info()
+    except PDFError:
+        raise
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError,
+            RuntimeError, zlib.error), e:
+        raise PDFError("Can't parse %s: %r" % (path, e))
+    finally:
+        data.close()
+
+
+class Document(object):
+    def __init__(self, data):
+        self.data = data
+        # Cross-reference sections, newest first
+        self.xref_sections = []
+        self.trailer = {}
+        self.object_streams = {}
+        self.read_xref()
+
+    def info(self):
+        catalog = self.resolve(self.trailer.get('Root'))
+        if not isinstance(catalog, dict):
+            raise PDFError("No document catalog")
+        pages = self.resolve(catalog.get('Pages'))
+        if not isinstance(pages, dict):
+            raise PDFError("No page tree")
+        count = self.resolve(pages.get('Count'))
+        if not isinstance(count, (int, long)) or isinstance(count, bool) \
+           or count < 1:
+            raise PDFError("Bad page count %r" % (count,))
+        info = {'pages': count}
+
+        # Strings are encrypted along with everything else
+        if 'Encrypt' not in self.trailer:
+            docinfo = self.resolve(self.trailer.get('Info'))
+            if isinstance(docinfo, dict):
+                for key in INFO_KEYS:
+                    value = self.resolve(docinfo.get(key))
+                    if isinstance(value, str):
+                        info[key] = decode_text(value)
+        return info
+
+    def read_xref(self):
+        data = self.data
+        pos = data.rfind('startxref', max(0, len(data) - TAIL_SIZE))
+        if pos == -1:
+            raise PDFError("No startxref")
+        match = INTEGER_RE.match(data, pos + len('startxref'))
+        if not match:
+            raise PDFError("Bad startxref")
+        offset = int(match.group(1))
+        seen = set()
+        while offset is not None:
+            if offset in seen:
+                raise PDFError("Cross-reference loop at %d" % offset)
+            seen.add(offset)
+            trailer = self.read_xref_section(offset)
+            if 'XRefStm' in trailer:
+                # Hybrid-reference file: the table's entries come first,
+                # then the compressed objects in the stream.
+                self.read_xref_section(trailer['XRefStm'])
+            for key, value in trailer.iteritems():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get('Prev')
+
+    def read_xref_section(self, offset):
+        if self.data[offset:offset + 4] == 'xref':
+            return self.read_xref_table(offset + 4)
+        else:
+            return self.read_xref_stream(offset)
+
+    def read_xref_table(self, pos):
+        data = self.data
+        parser = Parser(data, pos)
+        while True:
+            parser.skip_whitespace()
+            if data[parser.pos:parser.pos + 7] == 'trailer':
+                parser.pos += 7
+                trailer = parser.parse_object()
+                if not isinstance(trailer, dict):
+                    raise PDFError("Bad trailer")
+                return trailer
+            start = parser.parse_int()
+            count = parser.parse_int()
+            parser.skip_whitespace()
+            self.xref_sections.append(XrefTable(data, start, count, parser.pos))
+            parser.pos += count * 20
+
+    def read_xref_stream(self, offset):
+        num, gen, stream = self.read_indirect_object(offset)
+        if not isinstance(stream, Stream) or stream.dict.get('Type') != 'XRef':
+            raise PDFError("No cross-reference at %d" % offset)
+        widths = stream.dict['W']
+        index = stream.dict.get('Index', [0, stream.dict['Size']])
+        content = decode_stream(stream)
+        self.xref_sections.append(XrefStream(content, widths, index))
+        return stream.dict
+
+    def lookup(self, num):
+        for section in self.xref_sections:
+            entry = section.get(num)
+            if entry is not MISSING:
+                return entry
+        return None
+
+    def get_object(self, num):
+        entry = self.lookup(num)
+        if entry is None:
+            return None
+        elif entry[0] == 1:
+            objnum, gen, obj = self.read_indirect_object(entry[1])
+            if objnum != num:
+                raise PDFError("Expected object %d at %d, found %d"
+                               % (num, entry[1], objnum))
+            return obj
+        else:
+            return self.get_compressed_object(num, entry[1], entry[2])
+
+    def get_compressed_object(self, num, stream_num, index):
+        if stream_num not in self.object_streams:
+            stream = self.get_object(stream_num)
+            if not isinstance(stream, Stream):
+                raise PDFError("No object stream %d" % stream_num)
+            content = decode_stream(stream)
+            parser = Parser(content)
+            offsets = [(parser.parse_int(), parser.parse_int())
+                       for i in xrange(stream.dict['N'])]
+            self.object_streams[stream_num] = (content,
+                                               stream.dict['First'],
+                                               offsets)
+        content, first, offsets = self.object_streams[stream_num]
+        objnum, offset = offsets[index]
+        if objnum != num:
+            raise PDFError("Expected object %d in object stream %d, found %d"
+                           % (num, stream_num, objnum))
+        return Parser(content, first + offset).parse_object()
+
+    def read_indirect_object(self, offset):
+        data = self.data
+        obj_match = OBJ_RE.match(data, offset)
+        if not obj_match:
+            raise PDFError("No object at %d" % offset)
+        parser = Parser(data, obj_match.end())
+        obj = parser.parse_object()
+        stream_match = STREAM_RE.match(data, parser.pos)
+        if isinstance(obj, dict) and stream_match:
+            start = stream_match.end()
+            length = self.resolve(obj.get('Length'))
+            if not isinstance(length, (int, long)) \
+               or data[start + length:start + length + 20].lstrip(WS)[:9] \
+               != 'endstream':
+                end = data.find('endstream', start)
+                if end == -1:
+                    raise PDFError("Unterminated stream at %d" % offset)
+                length = end - start
+            obj = Stream(obj, data[start:start + length])
+        return int(obj_match.group(1)), int(obj_match.group(2)), obj
+
+    def resolve(self, obj):
+        depth = 0
+        while isinstance(obj, Ref):
+            depth += 1
+            if depth > MAX_REF_DEPTH:
+                raise PDFError("Too many levels of references")
+            obj = self.get_object(obj.num)
+        return obj
+
+
+# Returned by cross-reference sections for objects they don't list
+MISSING = object()
+
+
+class XrefTable(object):
+    """A subsection of a cross-reference table, read lazily"""
+
+    def __init__(self, data, start, count, pos):
+        self.data = data
+        self.start = start
+        self.count = count
+        self.pos = pos
+
+    def get(self, num):
+        if not self.start <= num < self.start + self.count:
+            return MISSING
+        entry_pos = self.pos + (num - self.start) * 20
+        match = XREF_ENTRY_RE.match(self.data[entry_pos:entry_pos + 20])
+        if not match:
+            raise PDFError("Bad cross-reference entry at %d" % entry_pos)
+        if match.group(3) == 'f':
+            return None
+        return (1, int(match.group(1)))
+
+
+class XrefStream(object):
+    """The decoded entries of a cross-reference stream, read lazily"""
+
+    def __init__(self, content, widths, index):
+        self.content = content
+        self.widths = widths
+        self.row_size = sum(widths)
+        self.subsections = []
+        row = 0
+        for i in xrange(0, len(index), 2):
+            self.subsections.append((index[i], index[i + 1], row))
+            row += index[i + 1]
+
+    def get(self, num):
+        for start, count, row in self.subsections:
+            if start <= num < start + count:
+                break
+        else:
+            return MISSING
+        pos = (row + num - start) * self.row_size
+        fields = []
+        for width in self.widths:
+            value = 0
+            for byte in self.content[pos:pos + width]:
+                value = value * 256 + ord(byte)
+            pos += width
+            fields.append(value)
+        entry_type = fields[0] if self.widths[0] else 1
+        if entry_type == 1:
+            return (1, fields[1])
+        elif entry_type == 2:
+            return (2, fields[1], fields[2])
+        else:
+            return None
+
+
+class Parser(object):
+    """Parses PDF objects from data (a str or mmap) starting at pos"""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def skip_whitespace(self):
+        self.pos = WHITESPACE_RE.match(self.data, self.pos).end()
+
+    def parse_int(self):
+        value = self.parse_object()
+        if not isinstance(value, (int, long)):
+            raise PDFError("Expected an integer, found %r" % (value,))
+        return value
+
+    def parse_object(self):
+        self.skip_whitespace()
+        data = self.data
+        pos = self.pos
+        char = data[pos:pos + 1]
+        if char == '':
+            raise PDFError("Unexpected end of data")
+        elif data[pos:pos + 2] == '<<':
+            self.pos += 2
+            return self.parse_dict()
+        elif char == '<':
+            return self.parse_hex_string()
+        elif char == '[':
+            self.pos += 1
+            return self.parse_array()
+        elif char == '(':
+            return self.parse_literal_string()
+        elif char == '/':
+            match = NAME_RE.match(data, pos)
+            self.pos = match.end()
+            return Name(NAME_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)),
+                                           match.group(1)))
+
+        match = NUMBER_RE.match(data, pos)
+        if match:
+            self.pos = match.end()
+            token = match.group()
+            if '.' in token:
+                return float(token)
+            value = int(token)
+            match = REF_RE.match(data, self.pos)
+            if match:
+                self.pos = match.end()
+                return Ref(value, int(match.group(1)))
+            return value
+
+        match = KEYWORD_RE.match(data, pos)
+        if match:
+            self.pos = match.end()
+            keyword = match.group()
+            if keyword == 'true':
+                return True
+            elif keyword == 'false':
+                return False
+            elif keyword == 'null':
+                return None
+            raise PDFError("Unexpected keyword %r at %d" % (keyword, pos))
+        raise PDFError("Unexpected %r at %d" % (char, pos))
+
+    def parse_dict(self):
+        result = {}
+        while True:
+            self.skip_whitespace()
+            if self.data[self.pos:self.pos + 2] == '>>':
+                self.pos += 2
+                return result
+            key = self.parse_object()
+            if not isinstance(key, Name):
+                raise PDFError("Expected a name, found %r" % (key,))
+            result[str(key)] = self.parse_object()
+
+    def parse_array(self):
+        result = []
+        while True:
+            self.skip_whitespace()
+            if self.data[self.pos:self.pos + 1] == ']':
+                self.pos += 1
+                return result
+            result.append(self.parse_object())
+
+    def parse_hex_string(self):
+        match = HEX_STRING_RE.match(self.data, self.pos)
+        if not match:
+            raise PDFError("Bad hex string at %d" % self.pos)
+        self.pos = match.end()
+        digits = ''.join(match.group(1).split())
+        if len(digits) % 2:
+            digits += '0'
+        return digits.decode('hex')
+
+    def parse_literal_string(self):
+        data = self.data
+        pos = self.pos + 1
+        depth = 1
+        chars = []
+        while True:
+            char = data[pos:pos + 1]
+            if char == '':
+                raise PDFError("Unterminated string at %d" % self.pos)
+            pos += 1
+            if char == '\\':
+                char = data[pos:pos + 1]
+                pos += 1
+                if char in STRING_ESCAPES:
+                    chars.append(STRING_ESCAPES[char])
+                elif char and char in '01234567':
+                    octal = char
+                    while len(octal) < 3 and data[pos:pos + 1] \
+                          and data[pos:pos + 1] in '01234567':
+                        octal += data[pos]
+                        pos += 1
+                    chars.append(chr(int(octal, 8) & 0xff))
+                elif char == '\r':
+                    if data[pos:pos + 1] == '\n':
+                        pos += 1
+                elif char != '\n':
+                    chars.append(char)
+            elif char == '(':
+                depth += 1
+                chars.append(char)
+            elif char == ')':
+                depth -= 1
+                if depth == 0:
+                    self.pos = pos
+                    return ''.join(chars)
+                chars.append(char)
+            else:
+                chars.append(char)
+
+
+def decode_stream(stream):
+    filters = stream.dict.get('Filter')
+    if filters is None:
+        return stream.raw
+    if isinstance(filters, Name):
+        filters = [filters]
+    if filters != ['FlateDecode']:
+        raise PDFError("Unsupported stream filter %r" % (filters,))
+    content = zlib.decompressobj().decompress(stream.raw)
+
+    params = stream.dict.get('DecodeParms') or {}
+    if isinstance(params, list):
+        params = params[0] or {}
+    predictor = params.get('Predictor', 1)
+    if predictor >= 10:
+        if params.get('Colors', 1) != 1 or params.get('BitsPerComponent', 8) != 8:
+            raise PDFError("Unsupported predictor parameters %r" % (params,))
+        content = png_unpredict(content, params.get('Columns', 1))
+    elif predictor != 1:
+        raise PDFError("Unsupported predictor %r" % predictor)
+    return content
+
+
+def png_unpredict(content, columns):
+    """
+    Undo PNG row prediction with one byte per pixel, as used for
+    cross-reference streams.
+    """
+    row_size = columns + 1
+    previous = bytearray(columns)
+    result = bytearray()
+    for pos in xrange(0, len(content) - columns, row_size):
+        filter_type = ord(content[pos])
+        row = bytearray(content[pos + 1:pos + row_size])
+        if filter_type == 1:
+            for i in xrange(1, len(row)):
+                row[i] = (row[i] + row[i - 1]) & 0xff
+        elif filter_type == 2:
+            for i in xrange(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif filter_type != 0:
+            raise PDFError("Unsupported PNG filter type %d" % filter_type)
+        result += row
+        previous = row
+    return str(result)
+
+
+def decode_text(value):
+    """Decode a PDF text string: UTF-16BE with a byte order mark, or
+    PDFDocEncoding which we treat as Latin-1."""
+    if value.startswith('\xfe\xff'):
+        return value[2:].decode('utf-16-be', 'replace')
+    return value.decode('latin-1')
@@ -0,0 +1,78 @@
+"""
+Volume numbers inferred from publication dates.
+
+A publication's volume number only goes up, a new volume starting every so
+often, so the volume of a gazette can be looked up from the dates and
+volumes of the gazettes already archived. A date is only resolved if it
+falls within a run of archived gazettes of the publication which all have
+the same volume, so gazettes published around the start of a new volume
+still need their volume read from their cover page.
+"""
+
+from bisect import bisect_right
+from collections import defaultdict
+from gazettes.models import ArchivedGazette
+
+
+class VolumeIndex(object):
+    """
+    Ranges of (first date, last date, volume number) by (publication_title,
+    jurisdiction_code), sorted by date. Small enough to be sent to worker
+    processes.
+    """
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.first_dates = dict((key, [first for first, last, volume
+                                       in key_ranges])
+                                for key, key_ranges in ranges.iteritems())
+
+    @classmethod
+    def load(cls, session):
+        volumes = defaultdict(lambda: defaultdict(set))
+        rows = session.query(ArchivedGazette.publication_title,
+                             ArchivedGazette.jurisdiction_code,
+                             ArchivedGazette.publication_date,
+                             ArchivedGazette.volume_number)\
+                      .filter(ArchivedGazette.volume_number != None)
+        for publication_title, jurisdiction_code, publication_date, volume in rows:
+            volumes[(publication_title, jurisdiction_code)][publication_date].add(volume)
+        return cls(dict((key, build_ranges(volumes_by_date))
+                        for key, volumes_by_date in volumes.iteritems()))
+
+    def __len__(self):
+        return sum(len(key_ranges) for key_ranges in self.ranges.itervalues())
+
+    def get(self, publication_title, jurisdiction_code, publication_date):
+        """The volume number, or None if the date can't be resolved"""
+        key = (publication_title, jurisdiction_code)
+        first_dates = self.first_dates.get(key)
+        if not first_dates:
+            return None
+        i = bisect_right(first_dates, publication_date) - 1
+        if i < 0:
+            return None
+        first, last, volume = self.ranges[key][i]
+        if publication_date <= last:
+            return volume
+        return None
+
+
+def build_ranges(volumes_by_date):
+    """
+    Merge the volumes seen on each date into ranges of dates with the same
+    volume. Dates with gazettes in more than one volume break ranges.
+    """
+    ranges = []
+    for publication_date in sorted(volumes_by_date):
+        volumes = volumes_by_date[publication_date]
+        if len(volumes) != 1:
+            ranges.append(None)
+            continue
+        volume = next(iter(volumes))
+        if ranges and ranges[-1] is not None and ranges[-1][2] == volume:
+            ranges[-1][1] = publication_date
+        else:
+            ranges.append([publication_date, publication_date, volume])
+    return [tuple(volume_range) for volume_range in ranges
+            if volume_range is not None]
@@ -0,0 +1,77 @@
+"""
+The gazettes already in web_scraped_gazette, loaded once when a crawl
+starts so that the pipelines can tell which scraped gazettes are new
+without asking the file store or the database about each one.
+"""
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from gazettes.models import WebScrapedGazette
+import hashlib
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Bytes of the SHA-1 of each original_uri that are kept. Two URIs can share
+# a key, so a match only means a gazette is probably known - callers check
+# the store_path it gives them.
+KEY_BYTES = 8
+# Number of rows fetched from the database at a time
+LOAD_BATCH_SIZE = 10000
+
+# KnownGazettes by crawler, so the pipelines of a crawl share one
+known_by_crawler = weakref.WeakKeyDictionary()
+
+
+def uri_key(original_uri):
+    if isinstance(original_uri, unicode):
+        original_uri = original_uri.encode('utf-8')
+    return hashlib.sha1(original_uri).digest()[:KEY_BYTES]
+
+
+class KnownGazettes(object):
+    """
+    The store_path of every scraped gazette by a truncated hash of its
+    original_uri. The keys are a fixed size however long the URIs are, but
+    the store_paths are kept whole, so this still takes memory in
+    proportion to the number of gazettes scraped.
+    """
+
+    def __init__(self, store_paths):
+        self.store_paths = store_paths
+
+    @classmethod
+    def load(cls, db_uri):
+        engine = create_engine(db_uri)
+        session = sessionmaker(bind=engine)()
+        try:
+            rows = session.query(WebScrapedGazette.original_uri,
+                                 WebScrapedGazette.store_path)\
+                          .yield_per(LOAD_BATCH_SIZE)
+            store_paths = dict((uri_key(original_uri), store_path)
+                               for original_uri, store_path in rows)
+        finally:
+            session.close()
+            engine.dispose()
+        logger.info("Loaded %d known gazettes", len(store_paths))
+        return cls(store_paths)
+
+    def __len__(self):
+        return len(self.store_paths)
+
+    def get(self, original_uri):
+        """The store_path of a probably-known gazette, otherwise None"""
+        return self.store_paths.get(uri_key(original_uri))
+
+    def add(self, original_uri, store_path):
+        self.store_paths[uri_key(original_uri)] = store_path
+
+
+def for_crawler(crawler):
+    """The KnownGazettes of a crawl, loaded by whichever pipeline asks first"""
+    known = known_by_crawler.get(crawler)
+    if known is None:
+        known = KnownGazettes.load(crawler.settings.get('GAZETTE_DB_URI'))
+        known_by_crawler[crawler] = known
+    return known
@@ -5,48 +5,258 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import sqlalchemy.sql.functions as func
-from gazettes.models import WebScrapedGazette
+from collections import OrderedDict
+from sqlalchemy import create_engine, text
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+from gazettescrape import known
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of items upserted per statement
+DEFAULT_BATCH_SIZE = 500
+# Seconds an item may wait in the buffer before it's written
+DEFAULT_FLUSH_INTERVAL = 5
+# Number of threads writing batches. Database work never happens on the
+# reactor thread.
+DEFAULT_THREADS = 1
+# Items stop flowing through the pipeline while this many batches are
+# waiting to be written
+DEFAULT_MAX_PENDING = 4
+# Seconds between checks of how late the reactor runs a scheduled call
+REACTOR_LATENCY_INTERVAL = 1.0
+
+# Upserts a batch of gazettes in one statement, with the batch's columns
+# passed as arrays. Gazettes seen before only get their last_seen and
+# referrer updated. Needs Postgres 9.5 or later.
+UPSERT_SQL = text("""
+    INSERT INTO web_scraped_gazette (label, original_uri, referrer, store_path,
+                                     published_date, first_seen, last_seen,
+                                     manually_ignored)
+    SELECT label, original_uri, referrer, store_path, published_date,
+           now(), now(), false
+    FROM unnest(CAST(:labels AS text[]),
+                CAST(:original_uris AS text[]),
+                CAST(:referrers AS text[]),
+                CAST(:store_paths AS text[]),
+                CAST(:published_dates AS date[]))
+         AS item(label, original_uri, referrer, store_path, published_date)
+    ON CONFLICT (original_uri) DO UPDATE
+    SET last_seen = EXCLUDED.last_seen,
+        referrer = EXCLUDED.referrer,
+        updated_at = now()""")
+
+# Marks gazettes which are known to be in the database as seen again.
+# Returns the original_uris it found.
+TOUCH_SQL = text("""
+    UPDATE web_scraped_gazette AS gazette
+    SET last_seen = now(),
+        referrer = item.referrer,
+        updated_at = now()
+    FROM unnest(CAST(:original_uris AS text[]),
+                CAST(:referrers AS text[]))
+         AS item(original_uri, referrer)
+    WHERE gazette.original_uri = item.original_uri
+    RETURNING gazette.original_uri""")
 
 
 class DBPipeline(object):
-    def __init__(self, db_uri):
+    """
+    Records scraped gazettes in web_scraped_gazette. Items are buffered and
+    upserted batch_size at a time, when the oldest one has waited
+    flush_interval seconds, and when the spider closes.
+
+    Batches are written by a pool of threads so that a slow database doesn't
+    stall the crawl. Once max_pending batches are waiting to be written,
+    process_item returns Deferreds which only fire when one of them is done,
+    which holds items back in the scraper.
+
+    Gazettes which were in the database when the crawl started only have
+    last_seen and referrer updated, without trying to insert them.
+    """
+
+    def __init__(self, db_uri, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 threads=DEFAULT_THREADS, max_pending=DEFAULT_MAX_PENDING):
         self.db_uri = db_uri
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.threads = threads
+        self.max_pending = max_pending
         self.engine = None
-        self.Session = None
+        self.thread_pool = None
+        self.known = None
+        self.flush_loop = None
+        self.latency_loop = None
+        # Writes in flight, and items waiting for one of them to finish
+        self.pending = []
+        self.waiting = []
+        # When the reactor latency check should next run
+        self.latency_expected = None
+        # original_uri -> item, so an item scraped twice before a flush is
+        # only written once
+        self.buffer = OrderedDict()
+        self.last_flush = time.time()
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             db_uri=crawler.settings.get('GAZETTE_DB_URI'),
+            batch_size=crawler.settings.getint('DB_PIPELINE_BATCH_SIZE',
+                                               DEFAULT_BATCH_SIZE),
+            flush_interval=crawler.settings.getfloat('DB_PIPELINE_FLUSH_INTERVAL',
+                                                     DEFAULT_FLUSH_INTERVAL),
+            threads=crawler.settings.getint('DB_PIPELINE_THREADS',
+                                            DEFAULT_THREADS),
+            max_pending=crawler.settings.getint('DB_PIPELINE_MAX_PENDING',
+                                                DEFAULT_MAX_PENDING),
         )
 
     def open_spider(self, spider):
-        self.engine = create_engine(self.db_uri)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = create_engine(self.db_uri, pool_size=self.threads)
+        self.known = known.for_crawler(spider.crawler)
+        self.thread_pool = ThreadPool(minthreads=1, maxthreads=self.threads,
+                                      name='DBPipeline')
+        self.thread_pool.start()
+        self.flush_loop = task.LoopingCall(self.flush_if_due, spider)
+        self.flush_loop.start(self.flush_interval, now=False)
+        self.latency_loop = task.LoopingCall(self.measure_latency, spider)
+        self.latency_loop.start(REACTOR_LATENCY_INTERVAL, now=False)
 
     def close_spider(self, spider):
+        """Returns a Deferred which fires once every batch is written"""
+        for loop in (self.flush_loop, self.latency_loop):
+            if loop.running:
+                loop.stop()
+        self.flush(spider)
+        dfd = defer.DeferredList(list(self.pending))
+        dfd.addBoth(lambda _: self.shut_down())
+        return dfd
+
+    def shut_down(self):
+        self.thread_pool.stop()
         self.engine.dispose()
 
     def process_item(self, item, spider):
-        original_uri = item['file_urls'][0]
-        session = self.Session()
-        gazette = session.query(WebScrapedGazette).filter_by(original_uri=original_uri).first()
-        if gazette:
-            gazette.last_seen = func.now()
-            gazette.referrer = item['referrer']
+        if not item.get('files'):
+            # The download failed, so there's nothing to record. It's tried
+            # again next crawl.
+            spider.crawler.stats.inc_value('db/items_without_files', spider=spider)
+            logger.warning("Not recording %s: its file wasn't stored",
+                           item['file_urls'][0], extra={'spider': spider})
+            return item
+        self.buffer[item['file_urls'][0]] = item
+        if len(self.buffer) >= self.batch_size:
+            self.flush(spider)
         else:
-            gazette = WebScrapedGazette(
-                label=item['label'],
-                original_uri=item['file_urls'][0],
-                referrer=item['referrer'],
-                store_path=item['files'][0]['path'],
-                published_date=item['published_date'],
-                last_seen=func.now(),
-                first_seen=func.now()
-            )
-            session.add(gazette)
-        session.commit()
-        return item
+            self.flush_if_due(spider)
+        if len(self.pending) < self.max_pending:
+            return item
+        spider.crawler.stats.inc_value('db/backpressure_waits', spider=spider)
+        dfd = defer.Deferred()
+        self.waiting.append((dfd, item))
+        return dfd
+
+    def flush_if_due(self, spider):
+        if self.buffer and time.time() - self.last_flush >= self.flush_interval:
+            self.flush(spider)
+
+    def flush(self, spider):
+        """Start writing the buffered items in the thread pool"""
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        items = self.buffer.values()
+        self.buffer = OrderedDict()
+        touches = []
+        new = []
+        for item in items:
+            try:
+                is_known = self.known.get(item['file_urls'][0]) \
+                           == item['files'][0]['path']
+            except Exception:
+                # Only this item is lost, not the rest of the batch
+                spider.crawler.stats.inc_value('db/upsert_errors', spider=spider)
+                logger.exception("Not recording malformed item %r", item,
+                                 extra={'spider': spider})
+                continue
+            if is_known:
+                touches.append(item)
+            else:
+                new.append(item)
+        items = touches + new
+        if not items:
+            return
+        dfd = threads.deferToThreadPool(reactor, self.thread_pool,
+                                        self.upsert, touches, new)
+        dfd.addCallbacks(self.upserted, self.upsert_failed,
+                         callbackArgs=(items, spider),
+                         errbackArgs=(items, spider))
+        dfd.addBoth(self.written, dfd, spider)
+        self.pending.append(dfd)
+        self.set_queue_stats(spider)
+
+    def upsert(self, touches, new):
+        """
+        Runs in the thread pool. Known gazettes which weren't found after
+        all are upserted with the new ones. Returns the items upserted.
+        """
+        with self.engine.begin() as conn:
+            if touches:
+                touched = set(row[0] for row in conn.execute(
+                    TOUCH_SQL,
+                    original_uris=[item['file_urls'][0] for item in touches],
+                    referrers=[item['referrer'] for item in touches]))
+                new = new + [item for item in touches
+                             if item['file_urls'][0] not in touched]
+            if new:
+                conn.execute(UPSERT_SQL,
+                             labels=[item['label'] for item in new],
+                             original_uris=[item['file_urls'][0] for item in new],
+                             referrers=[item['referrer'] for item in new],
+                             store_paths=[item['files'][0]['path'] for item in new],
+                             published_dates=[item['published_date'] for item in new])
+        return new
+
+    def upserted(self, new, items, spider):
+        for item in new:
+            self.known.add(item['file_urls'][0], item['files'][0]['path'])
+        stats = spider.crawler.stats
+        stats.inc_value('db/upserted', len(new), spider=spider)
+        stats.inc_value('db/touched', len(items) - len(new), spider=spider)
+        stats.inc_value('db/flushes', spider=spider)
+
+    def upsert_failed(self, failure, items, spider):
+        # They're scraped again next crawl
+        spider.crawler.stats.inc_value('db/upsert_errors', len(items),
+                                       spider=spider)
+        logger.error("Error writing %d gazettes to the database: %s",
+                     len(items), failure.getErrorMessage(),
+                     extra={'spider': spider})
+
+    def written(self, result, dfd, spider):
+        self.pending.remove(dfd)
+        while self.waiting and len(self.pending) < self.max_pending:
+            waiting_dfd, item = self.waiting.pop(0)
+            waiting_dfd.callback(item)
+        self.set_queue_stats(spider)
+
+    def set_queue_stats(self, spider):
+        stats = spider.crawler.stats
+        stats.set_value('db/pending_writes', len(self.pending), spider=spider)
+        stats.max_value('db/pending_writes_max', len(self.pending), spider=spider)
+        stats.set_value('db/waiting_items', len(self.waiting), spider=spider)
+
+    def measure_latency(self, spider):
+        # How much later than scheduled the reactor got around to this call
+        now = time.time()
+        expected = self.latency_expected
+        self.latency_expected = now + REACTOR_LATENCY_INTERVAL
+        if expected is None:
+            return
+        latency = max(0.0, now - expected)
+        stats = spider.crawler.stats
+        stats.set_value('reactor/latency', latency, spider=spider)
+        stats.max_value('reactor/latency_max', latency, spider=spider)
@@ -22,6 +22,7 @@ except ImportError:
 from twisted.internet import defer, threads
 
 from gazettescrape.pipelines.media import MediaPipeline
+from gazettescrape import known
 
 from scrapy.settings import Settings
 from scrapy.exceptions import NotConfigured, IgnoreRequest
@@ -232,6 +233,8 @@ class FilesPipeline(MediaPipeline):
         self.expires = settings.getint('FILES_EXPIRES')
         self.files_urls_field = settings.get('FILES_URLS_FIELD')
         self.files_result_field = settings.get('FILES_RESULT_FIELD')
+        self.preload_known = bool(settings.get('GAZETTE_DB_URI'))
+        self.known = None
 
         super(FilesPipeline, self).__init__(download_func=download_func)
 
@@ -253,6 +256,11 @@ class FilesPipeline(MediaPipeline):
         store_cls = self.STORE_SCHEMES[scheme]
         return store_cls(uri)
 
+    def open_spider(self, spider):
+        super(FilesPipeline, self).open_spider(spider)
+        if self.preload_known:
+            self.known = known.for_crawler(spider.crawler)
+
     def media_to_download(self, request, info):
         def _onsuccess(result):
             if not result:
@@ -281,6 +289,13 @@ class FilesPipeline(MediaPipeline):
             return {'url': request.url, 'path': path, 'checksum': checksum}
 
         path = self.file_path(request, info=info)
+        # Gazettes are stored under the hash of their full URL, so a known
+        # gazette with this path is this file. Scraped gazettes don't
+        # change, so it isn't checked for expiry.
+        if self.known is not None and self.known.get(request.url) == path:
+            self.inc_stats(info.spider, 'known')
+            return {'url': request.url, 'path': path, 'checksum': None}
+
         dfd = defer.maybeDeferred(self.store.stat_file, path, info)
         dfd.addCallbacks(_onsuccess, lambda _: None)
         dfd.addErrback(
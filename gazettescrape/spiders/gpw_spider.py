@@ -1,10 +1,24 @@
 import scrapy
 from gazettescrape.items import GazetteItem
+from gazettescrape import known
 from datetime import datetime
 import urlparse
 
 
 class GpwSpider(scrapy.Spider):
+    """
+    Crawls the gazette listings of the Government Printing Works.
+
+    Listings are newest first, so by default a section's pages are only
+    followed until a page has nothing new on it: every gazette on it has
+    been scraped before, or was published before the cutoff date if one is
+    given (-a cutoff=YYYY-MM-DD). -a full=true follows every page.
+
+    Full crawls request every page linked from the pager at once instead of
+    one after the other. Each page links to the pages around it, so the
+    whole listing is reached, and pages linked from several pages are only
+    requested once by the duplicate filter.
+    """
     name = "gpw"
     allowed_domains = ["gpwonline.co.za"]
     start_urls = {
@@ -24,12 +38,16 @@ class GpwSpider(scrapy.Spider):
         'http://www.gpwonline.co.za/Gazettes/Pages/Road-Access-Permits.aspx',
     }
 
-    def __init__(self, start_url=None):
+    def __init__(self, start_url=None, full=None, cutoff=None, *args, **kwargs):
+        super(GpwSpider, self).__init__(*args, **kwargs)
         if start_url is not None:
             self.start_urls = [start_url]
+        self.full = full is not None and full.lower() in ('true', 'yes', '1')
+        self.cutoff = datetime.strptime(cutoff, '%Y-%m-%d') if cutoff else None
 
     def parse(self, response):
         gazette_row_css = '.GazetteTitle'
+        new_gazettes = 0
         for row in response.css(gazette_row_css):
             gazette_item = GazetteItem()
             label_xpath = 'div/a/text()'
@@ -41,9 +59,31 @@ class GpwSpider(scrapy.Spider):
             date = datetime.strptime(gpw_pub_date, '%d/%m/%Y')
             gazette_item['published_date'] = date.isoformat()
             gazette_item['referrer'] = response.url
+            if not self.full and self.is_new(gazette_item, date):
+                new_gazettes += 1
             yield gazette_item
 
-        next_page_xpath = '//div[@class="Paging"]/div/strong/following-sibling::a/@href'
-        next_pages = response.xpath(next_page_xpath)
-        if next_pages:
-            yield scrapy.Request(urlparse.urljoin(response.url, next_pages[0].extract()))
+        if not self.full and not new_gazettes:
+            self.logger.info("Nothing new on %s - not following the next page",
+                             response.url)
+            self.crawler.stats.inc_value('gpw/sections_stopped_early', spider=self)
+            return
+
+        if self.full:
+            page_xpath = '//div[@class="Paging"]/div/a/@href'
+            for page in response.xpath(page_xpath).extract():
+                yield scrapy.Request(urlparse.urljoin(response.url, page))
+        else:
+            next_page_xpath = '//div[@class="Paging"]/div/strong/following-sibling::a/@href'
+            next_pages = response.xpath(next_page_xpath)
+            if next_pages:
+                yield scrapy.Request(urlparse.urljoin(response.url, next_pages[0].extract()))
+
+    def is_new(self, gazette_item, date):
+        if self.cutoff is not None and date < self.cutoff:
+            return False
+        if not self.crawler.settings.get('GAZETTE_DB_URI'):
+            # Without a database nothing is known, so every page is followed
+            return True
+        known_gazettes = known.for_crawler(self.crawler)
+        return known_gazettes.get(gazette_item['file_urls'][0]) is None